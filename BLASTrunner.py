@@ -1,16 +1,161 @@
 import argparse
+import asyncio
+import codecs
+import concurrent.futures
+import concurrent.futures.process
+import contextlib
+import glob
+import gzip
+import hashlib
+import heapq
+import html
+import itertools
+import json
+import math
+import mmap
+import multiprocessing
+import os
+import pickle
+import queue
+import random
 import re
 import sqlite3
+import statistics
 import sys
+import tempfile
+import threading
 import time
+import uuid
 from xml.etree import ElementTree
 
-import backoff
 import requests
 
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
 
 # Set global variables
-BLAST_QUERY_URL = "https://blast.ncbi.nlm.nih.gov/blast/Blast.cgi"
+# BLASTRUNNER_URL points BLASTrunner at another BLAST URL API service, e.g. mock_blast_server.py
+BLAST_QUERY_URL = os.environ.get(
+    "BLASTRUNNER_URL", "https://blast.ncbi.nlm.nih.gov/blast/Blast.cgi"
+)
+BLAST_PROGRAM = "blastn"
+BLAST_DATABASE = "nr"
+
+# Size, in bytes, of the pieces in which streamed results are read off the network
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# XML parser backends: lxml's C parser (used by default when it is installed), or the standard
+# library's ElementTree. Streaming parses only need events for the elements in XML_EVENT_TAGS,
+# and lxml skips reporting the rest, which make up most of a BLAST XML document.
+XML_BACKENDS = ["lxml", "stdlib"]
+XML_BACKEND = "stdlib" if lxml_etree is None else "lxml"
+XML_EVENT_TAGS = ["Iteration", "Iteration_hits", "Hit", "Hit_hsps", "Hsp"]
+
+# Child elements read into each queries, hits, and hsps row
+QUERY_FIELDS = ("Iteration_query-ID", "Iteration_query-def", "Iteration_query-len")
+HIT_FIELDS = ("Hit_id", "Hit_def", "Hit_accession")
+HSP_FIELDS = ("Hsp_align-len", "Hsp_bit-score", "Hsp_evalue", "Hsp_gaps")
+
+# The elements read by _scan_xml_results, and the end of each Hsp. The tag alternatives are
+# grouped by shared prefix, which makes the scan markedly faster. Empty elements written as
+# <tag/> match with no text.
+XML_SCAN_PATTERN = re.compile(
+    rb"<(H(?:sp_(?:align-len|bit-score|evalue|gaps)|it_(?:id|def|accession))"
+    rb"|Iteration_query-(?:ID|def|len))(?:/>|>([^<]*)<)|</Hsp>"
+)
+
+# Formats web BLAST can return results in. Results are fetched as XML unless another format is
+# asked for: only XML is checked against NCBI's own output (test.xml), while the JSON2_S and
+# Tabular readers follow NCBI's documented layouts and are only checked against the synthetic
+# results of mock_blast_server.py, so are not chosen automatically. Single-file JSON (JSON2_S)
+# fills in every column of the output database. The Tabular report is far smaller, as it leaves
+# out the aligned sequences, but also lacks the query and hit definitions, query lengths (and
+# so percentID), and gap counts, which it leaves NULL, and identifies queries by their fasta ID
+# rather than web BLAST's Query_ ID, so its rows do not merge with those of the other formats.
+RESULT_FORMATS = ["XML", "JSON2_S", "Tabular"]
+
+# Where each value is read from in a Tabular report: the names of the columns, as listed in
+# its "# Fields:" line, that hold it, in order of preference
+TABULAR_COLUMNS = {
+    "queryID": ["query id", "query acc.ver", "query acc."],
+    "queryDef": ["query title"],
+    "queryLength": ["query length"],
+    "hitID": ["subject id", "subject acc.ver", "subject acc."],
+    "hitDef": ["subject title"],
+    "accession": ["subject acc.", "subject acc.ver"],
+    "alignLength": ["alignment length"],
+    "bitScore": ["bit score"],
+    "eValue": ["evalue"],
+    "gaps": ["gaps"],
+}
+
+# The start of the list of per-query reports in a JSON2_S document, and the separators
+# between the reports
+JSON_REPORTS_START = re.compile(r'"BlastOutput2"\s*:\s*\[')
+JSON_SEPARATORS = re.compile(r"[\s,]*")
+
+# Errors that mark a BLAST XML file as unreadable during ingest: missing or unreadable files,
+# XML syntax errors, elements missing from or malformed in the results (a missing element
+# leaves None where its value is needed, raising TypeError), and a worker process parsing part of
+# the file dying, e.g. killed for running out of memory
+INGEST_ERRORS = (
+    OSError,
+    SyntaxError,
+    LookupError,
+    ValueError,
+    TypeError,
+    concurrent.futures.process.BrokenProcessPool,
+)
+
+# Size, in bytes, of the pieces _parse_xml_file_parallel splits a file into at most; bounds the
+# rows each worker returns at once
+PARSE_RANGE_SIZE = 16 * 1024 * 1024
+
+# In a worker process of _read_xml_files_parallel, the queue its rows are sent to the writer on
+_ingest_messages = None
+
+# NCBI usage guidelines: no more than one submission every 10 seconds, and no more than
+# one status check per minute for any one RID
+SUBMIT_INTERVAL = 10
+POLL_INTERVAL = 60
+
+# Maximum number of status checks per second made across all outstanding RIDs
+POLL_RATE = 0.5
+
+# A status check that fails to reach web BLAST, or is answered with an HTTP error, is retried
+# up to POLL_RETRIES times in a row, after POLL_RETRY_DELAY seconds, doubling after each retry
+POLL_RETRIES = 5
+POLL_RETRY_DELAY = 10
+
+# Adaptive polling: once POLL_HISTORY_MIN similar searches have been recorded in a poll history
+# file, the first status check of a new search is scheduled at the fraction of its RTOE that
+# the most recent POLL_HISTORY_RECENT of them suggest on average, adjusted in steps of
+# POLL_STEP (in log scale) to aim for POLL_MISS_TARGET of first checks finding a search still
+# running (see _predict_first_poll). Check times are spread by up to POLL_JITTER of their
+# length, so many searches do not all check in at once; later checks are only ever delayed by
+# it, never brought forward. Only the most recent POLL_HISTORY_SIZE searches are kept.
+POLL_JITTER = 0.1
+POLL_MISS_TARGET = 0.1
+POLL_STEP = 0.3
+POLL_HISTORY_MIN = 3
+POLL_HISTORY_RECENT = 20
+POLL_HISTORY_SIZE = 1000
+
+# Number of connections kept open to web BLAST by a shared HTTP session
+POOL_SIZE = 10
+
+# Number of rows inserted into SQLite per executemany/commit during a streaming load
+BATCH_SIZE = 10000
+
+# Bump whenever the format of cached result rows changes, so stale entries are never reused
+CACHE_VERSION = 1
+
+# Start of a cache entry, giving the time it was created; read to check an entry is usable
+# without decompressing its rows
+CACHE_HEADER = re.compile(r'\{"created": ([0-9.eE+-]+),')
 
 CREATE_QUERIES_TABLE = (
     "CREATE TABLE IF NOT EXISTS queries "
@@ -18,45 +163,404 @@ CREATE_QUERIES_TABLE = (
 )
 CREATE_HITS_TABLE = (
     "CREATE TABLE IF NOT EXISTS hits "
-    "(hitID TEXT PRIMARY KEY, hitDef TEXT, accession TEXT, queryID TEXT, "
+    "(hitID TEXT, hitDef TEXT, accession TEXT, queryID TEXT, "
+    "PRIMARY KEY (queryID, hitID), "
     "FOREIGN KEY (queryID) REFERENCES queries (queryID))"
 )
 CREATE_HSPS_TABLE = (
     "CREATE TABLE IF NOT EXISTS hsps "
     "(hspID INTEGER PRIMARY KEY AUTOINCREMENT, alignLength INTEGER, "
-    "bitScore REAL, eValue REAL, gaps INTEGER, percentID REAL, hitID TEXT, "
-    "FOREIGN KEY (hitID) REFERENCES hits (hitID))"
+    "bitScore REAL, eValue REAL, gaps INTEGER, percentID REAL, hitID TEXT, queryID TEXT, "
+    "FOREIGN KEY (queryID, hitID) REFERENCES hits (queryID, hitID))"
 )
 
 CREATE_STATEMENTS = [CREATE_QUERIES_TABLE, CREATE_HITS_TABLE, CREATE_HSPS_TABLE]
 
+# Queries and hits are upserted, so results can be merged into an existing database
 INSERTS = {
-    "queries": "INSERT INTO queries(queryID, queryDef, queryLength) values (?,?,?)",
-    "hits": "INSERT INTO hits(hitID, hitDef, accession, queryID) values (?,?,?,?)",
-    "hsps": "INSERT INTO hsps(alignLength, bitScore, eValue, gaps, percentID, hitID) "
+    "queries": "INSERT INTO queries(queryID, queryDef, queryLength) values (?,?,?) "
+    "ON CONFLICT (queryID) DO UPDATE SET "
+    "queryDef = excluded.queryDef, queryLength = excluded.queryLength",
+    "hits": "INSERT INTO hits(hitID, hitDef, accession, queryID) values (?,?,?,?) "
+    "ON CONFLICT (queryID, hitID) DO UPDATE SET "
+    "hitDef = excluded.hitDef, accession = excluded.accession",
+    "hsps": "INSERT INTO hsps(alignLength, bitScore, eValue, gaps, percentID, hitID, queryID) "
+    "values (?,?,?,?,?,?,?)",
+}
+
+# The "integer" schema replaces the TEXT keys above with INTEGER rowid keys: each query and
+# each distinct hit sequence (subject) ID is stored once, and every foreign key is an integer
+CREATE_INTEGER_QUERIES_TABLE = (
+    "CREATE TABLE IF NOT EXISTS queries "
+    "(queryKey INTEGER PRIMARY KEY, queryID TEXT UNIQUE, queryDef TEXT, queryLength INTEGER)"
+)
+CREATE_SUBJECTS_TABLE = (
+    "CREATE TABLE IF NOT EXISTS subjects "
+    "(subjectKey INTEGER PRIMARY KEY, hitID TEXT UNIQUE, hitDef TEXT, accession TEXT)"
+)
+CREATE_INTEGER_HITS_TABLE = (
+    "CREATE TABLE IF NOT EXISTS hits "
+    "(hitKey INTEGER PRIMARY KEY, queryKey INTEGER, subjectKey INTEGER, "
+    "UNIQUE (queryKey, subjectKey), "
+    "FOREIGN KEY (queryKey) REFERENCES queries (queryKey), "
+    "FOREIGN KEY (subjectKey) REFERENCES subjects (subjectKey))"
+)
+CREATE_INTEGER_HSPS_TABLE = (
+    "CREATE TABLE IF NOT EXISTS hsps "
+    "(hspID INTEGER PRIMARY KEY, alignLength INTEGER, "
+    "bitScore REAL, eValue REAL, gaps INTEGER, percentID REAL, hitKey INTEGER, "
+    "FOREIGN KEY (hitKey) REFERENCES hits (hitKey))"
+)
+
+CREATE_INTEGER_STATEMENTS = [
+    CREATE_INTEGER_QUERIES_TABLE,
+    CREATE_SUBJECTS_TABLE,
+    CREATE_INTEGER_HITS_TABLE,
+    CREATE_INTEGER_HSPS_TABLE,
+]
+
+# Queries and hits already in the database are upserted with their existing keys, as in the
+# "text" schema, so a load counts them alongside the new ones
+INTEGER_INSERTS = {
+    "queries": "INSERT INTO queries(queryKey, queryID, queryDef, queryLength) values (?,?,?,?) "
+    "ON CONFLICT (queryKey) DO UPDATE SET "
+    "queryDef = excluded.queryDef, queryLength = excluded.queryLength",
+    "subjects": "INSERT INTO subjects(subjectKey, hitID, hitDef, accession) values (?,?,?,?)",
+    "hits": "INSERT INTO hits(hitKey, queryKey, subjectKey) values (?,?,?) "
+    "ON CONFLICT (hitKey) DO NOTHING",
+    "hsps": "INSERT INTO hsps(alignLength, bitScore, eValue, gaps, percentID, hitKey) "
     "values (?,?,?,?,?,?)",
 }
 
+# Table definitions and insert statements of each output schema; inserts are listed parents first
+SCHEMAS = {
+    "text": (CREATE_STATEMENTS, INSERTS),
+    "integer": (CREATE_INTEGER_STATEMENTS, INTEGER_INSERTS),
+}
+
+# Ledger of the web BLAST searches made for an output database, one row per search keyed by a
+# hash of its query (see _cache_key), so an interrupted run can be resumed without resubmitting
+# searches that are still running or already finished. It is kept in a database of its own next
+# to the output database (see _ledger_path), so it can be updated while results are loaded. A
+# search's status goes from WAITING to READY, then DONE once its results are loaded; or to
+# FAILED or UNKNOWN (expired). Its records are the cache keys of the fasta records it searched,
+# separated by spaces.
+CREATE_JOBS_TABLE = (
+    "CREATE TABLE IF NOT EXISTS jobs (jobKey TEXT PRIMARY KEY, RID TEXT, submitted REAL, "
+    "RTOE INTEGER, status TEXT, records TEXT)"
+)
+RESUMABLE_STATUSES = ["WAITING", "READY"]
+
+# Number of seconds to wait for the ledger database to be free when updating it
+LEDGER_TIMEOUT = 60
+
+# Secondary indexes of each schema. These are built once a load has finished, rather than
+# maintained row by row during it: "joins" indexes serve lookups and joins of hsps by hit (hits
+# by query are already covered by the hits table's key), and "all" also indexes hsps by percent
+# identity. Building more indexes takes longer but makes those queries faster.
+JOIN_INDEXES = {
+    "text": ["CREATE INDEX IF NOT EXISTS hsps_hit ON hsps (hitID, queryID, eValue, bitScore)"],
+    "integer": [
+        "CREATE INDEX IF NOT EXISTS hsps_hit ON hsps (hitKey, eValue, bitScore)",
+        "CREATE INDEX IF NOT EXISTS hits_subject ON hits (subjectKey)",
+    ],
+}
+FILTER_INDEXES = {
+    "text": ["CREATE INDEX IF NOT EXISTS hsps_percentID ON hsps (percentID)"],
+    "integer": ["CREATE INDEX IF NOT EXISTS hsps_percentID ON hsps (percentID)"],
+}
+INDEX_LEVELS = ["none", "joins", "all"]
+
+# Connection settings for bulk loads: write-ahead logging without a sync on every commit,
+# a 256 MB page cache, and temporary structures kept in memory
+LOAD_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-262144",
+    "PRAGMA temp_store=MEMORY",
+]
+
+# Callables, each handed a dict describing every stage of a run as it finishes: its "stage"
+# (submit, poll, wait, fetch, parse, initialize, load, or index), the "time" it finished, the
+# "seconds" it took, and what it handled, e.g. its "RID", "status", "bytes", or "rows" per
+# table. Hooks may be called from worker threads. Stages are only measured if there are hooks.
+METRIC_HOOKS = []
+METRIC_FORMATS = ["jsonl", "prometheus"]
+
+# Help text of the totals exported in the Prometheus text format, see _prometheus_metrics_hook
+PROMETHEUS_METRICS = {
+    "blastrunner_stage_total": "Number of times each stage of a run finished",
+    "blastrunner_stage_seconds_total": "Seconds spent in each stage of a run",
+    "blastrunner_stage_bytes_total": "Bytes of queries submitted and of results fetched",
+    "blastrunner_stage_rows_total": "Result rows parsed and loaded, by table",
+    "blastrunner_polls_total": "Status checks of web BLAST searches, by the status reported",
+}
+
 
-def _submit_query(fasta_file):
-    """Build query using input fasta file and submit to web BLAST to run blastn against nr database
+def _replace_file(path, write, opener=open):
+    """Write a file in full, then put it in place of path in one step, so that a concurrent
+    reader sees either the old file or the new one and never a partially written file
 
     Parameters
-        fasta_file (str): fasta file to use for querying web BLAST
+        path (str): path of the file to write
+        write (callable): writer of the file's contents, handed the file opened for writing
+        opener (callable): opener of the file in text mode, e.g. open or gzip.open
+
+    Returns
+        None
+    """
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    with opener(temp_path, "wt") as out:
+        write(out)
+    os.replace(temp_path, path)
+
+
+def _emit_metric(stage, seconds, **fields):
+    """Hand a finished stage of a run to each of METRIC_HOOKS
+
+    Parameters
+        stage (str): name of the stage, e.g. "fetch"
+        seconds (float): number of seconds the stage took
+        fields: what the stage handled, e.g. bytes=len(content)
+
+    Returns
+        None
+    """
+    if not METRIC_HOOKS:
+        return
+    event = {"stage": stage, "time": time.time(), "seconds": seconds}
+    event.update(fields)
+    for hook in METRIC_HOOKS:
+        hook(event)
+
+
+def _metered(items, meter, tally=None):
+    """Yield from items, adding the time spent waiting for each one to meter["seconds"]. This
+    separates the time taken by each step of a pipeline of generators, e.g. downloading,
+    parsing, and loading, which otherwise all run interleaved.
+
+    Parameters
+        items (iterable): the items, e.g. chunks downloaded or rows parsed
+        meter (dict): running measurements, updated in place
+        tally (callable): called with meter and each item to count it, e.g. _tally_bytes
+
+    Yields
+        item: each of items in turn
+    """
+    items = iter(items)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        finally:
+            meter["seconds"] += time.perf_counter() - start
+        if tally is not None:
+            tally(meter, item)
+        yield item
+
+
+def _tally_bytes(meter, chunk):
+    """Count the bytes of a chunk of a download in meter["bytes"]; a tally for _metered"""
+    meter["bytes"] = meter.get("bytes", 0) + len(chunk)
+
+
+def _tally_rows(meter, row):
+    """Count a (table, row) tuple in meter["rows"][table]; a tally for _metered"""
+    rows = meter.setdefault("rows", {})
+    rows[row[0]] = rows.get(row[0], 0) + 1
+
+
+def _jsonl_metrics_hook(out, run=None):
+    """Make a metrics hook that writes each stage to a file as a line of JSON
+
+    Parameters
+        out (file): text file to write to
+        run (str): identifier added to every line, to tell the stages of different runs apart
+
+    Returns
+        hook (callable): the hook, for METRIC_HOOKS
+    """
+    lock = threading.Lock()
+
+    def hook(event):
+        line = json.dumps(dict(event, run=run) if run else event)
+        with lock:
+            out.write(line + "\n")
+
+    return hook
+
+
+def _prometheus_metrics_hook(totals):
+    """Make a metrics hook that adds up the number, seconds, bytes, and rows of each stage, and
+    the status checks reporting each status, in the counters of PROMETHEUS_METRICS
+
+    Parameters
+        totals (dict): running totals, keyed by (metric name, labels) and updated in place;
+            see _format_prometheus
+
+    Returns
+        hook (callable): the hook, for METRIC_HOOKS
+    """
+    lock = threading.Lock()
+
+    def hook(event):
+        stage = (("stage", event["stage"]),)
+        samples = [
+            ("blastrunner_stage_total", stage, 1),
+            ("blastrunner_stage_seconds_total", stage, event["seconds"]),
+        ]
+        if "bytes" in event:
+            samples.append(("blastrunner_stage_bytes_total", stage, event["bytes"]))
+        for table, count in event.get("rows", {}).items():
+            samples.append(("blastrunner_stage_rows_total", stage + (("table", table),), count))
+        if event["stage"] == "poll":
+            samples.append(("blastrunner_polls_total", (("status", event["status"]),), 1))
+
+        with lock:
+            for name, labels, value in samples:
+                totals[name, labels] = totals.get((name, labels), 0) + value
+
+    return hook
+
+
+def _format_prometheus(totals):
+    """Write out metric totals in the Prometheus text exposition format
+
+    Parameters
+        totals (dict): totals kept by _prometheus_metrics_hook
+
+    Returns
+        text (str): the metrics, one counter sample per line
+    """
+    lines = []
+    for name, help_text in PROMETHEUS_METRICS.items():
+        samples = sorted(
+            (labels, value) for (metric, labels), value in totals.items() if metric == name
+        )
+        if not samples:
+            continue
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} counter".format(name))
+        for labels, value in samples:
+            label_text = ",".join('{}="{}"'.format(*label) for label in labels)
+            lines.append("{}{{{}}} {}".format(name, label_text, value))
+
+    return "".join(line + "\n" for line in lines)
+
+
+@contextlib.contextmanager
+def _exporting_metrics(metrics_file, metrics_format="jsonl"):
+    """Export the metrics of everything run in a with block to a file. As JSON lines, each stage
+    is appended to the file as it finishes; in the Prometheus text format, totals over the block
+    replace the file once it exits.
+
+    Parameters
+        metrics_file (str): path of the file to export to
+        metrics_format (str): one of METRIC_FORMATS
+
+    Returns
+        context manager adding its hook to METRIC_HOOKS for the duration of the block
+    """
+    totals = {}
+    with contextlib.ExitStack() as stack:
+        if metrics_format == "jsonl":
+            out = stack.enter_context(open(metrics_file, "a"))
+            hook = _jsonl_metrics_hook(out, uuid.uuid4().hex)
+        else:
+            hook = _prometheus_metrics_hook(totals)
+
+        METRIC_HOOKS.append(hook)
+        try:
+            yield
+        finally:
+            METRIC_HOOKS.remove(hook)
+            # a run that exits with an error still exports how far it got
+            if metrics_format == "prometheus":
+                _replace_file(metrics_file, lambda out: out.write(_format_prometheus(totals)))
+
+
+def _read_fasta(fasta_file):
+    """Split a fasta file into its individual records
+
+    Parameters
+        fasta_file (str): fasta file containing one or more sequences
+
+    Returns
+        records (list): one string per sequence, each including its ">" header line
+    """
+    with open(fasta_file, "r") as seq:
+        return _split_fasta(seq.read())
+
+
+def _split_fasta(text):
+    """Split fasta-formatted text, such as the query of a search, into its individual records
+
+    Parameters
+        text (str): one or more fasta records
+
+    Returns
+        records (list): one string per sequence, each including its ">" header line
+    """
+    return [record for record in re.split("^(?=>)", text, flags=re.MULTILINE) if record.strip()]
+
+
+def _chunk_records(records, chunk_size=None):
+    """Group fasta records (or their indices) into searches of at most chunk_size sequences each
+
+    Parameters
+        records (list): fasta records, as returned by _read_fasta
+        chunk_size (int): maximum number of sequences per search, or None for a single search
+
+    Returns
+        chunks (list): one list of records per search
+    """
+    if not chunk_size:
+        chunk_size = max(len(records), 1)
+
+    return [records[i : i + chunk_size] for i in range(0, len(records), chunk_size)]
+
+
+def _create_session(pool_size=POOL_SIZE):
+    """Create an HTTP session that keeps connections to web BLAST open between requests
+
+    Parameters
+        pool_size (int): maximum number of connections to keep open at once
+
+    Returns
+        session (obj of class requests.Session): session to pass to the web BLAST functions
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+
+    return session
+
+
+def _submit_sequences(query, session=None):
+    """Submit fasta-formatted sequences to web BLAST to run blastn against nr database
+
+    Parameters
+        query (str): one or more fasta records to search with
+        session (obj of class requests.Session): HTTP session to use, or None for a new connection
 
     Returns
         response_text (str): response text from the query request
     """
     blast_params = {}
     blast_params["CMD"] = "Put"
-    blast_params["DATABASE"] = "nr"
-    blast_params["PROGRAM"] = "blastn"
+    blast_params["DATABASE"] = BLAST_DATABASE
+    blast_params["PROGRAM"] = BLAST_PROGRAM
+    blast_params["QUERY"] = query
 
-    with open(fasta_file, "r") as seq:
-        blast_params["QUERY"] = seq.read()
-
-    response = requests.post(BLAST_QUERY_URL, params=blast_params)
+    # sent in the request body, as long queries would overflow the URL
+    start = time.perf_counter()
+    response = (session or requests).post(BLAST_QUERY_URL, data=blast_params)
     response_text = response.text
+    _emit_metric("submit", time.perf_counter() - start, bytes=len(query))
     print("Query submitted to web BLAST:")
 
     return response_text
@@ -88,13 +592,12 @@ def _parse_RID_RTOE(response_text):
     return RID, RTOE
 
 
-@backoff.on_predicate(backoff.fibo, lambda status: status == "WAITING", max_value=60)
-def _check_status(RID):
-    """Check the status of a query submitted to web BLAST using query's RID. Backoff/retry
-    while status equals 'WAITING'.
+def _check_status(RID, session=None):
+    """Check the status of a query submitted to web BLAST using query's RID
 
     Parameters
         RID (str): the RID of the query for which to perform status check
+        session (obj of class requests.Session): HTTP session to use, or None for a new connection
 
     Returns
         status (str): query status reported by BLAST ("WAITING", "FAILED", "UNKNOWN", or "READY")
@@ -104,38 +607,245 @@ def _check_status(RID):
     blast_params["FORMAT_OBJECT"] = "SearchInfo"
     blast_params["RID"] = RID
 
-    response = requests.post(BLAST_QUERY_URL, params=blast_params)
+    start = time.perf_counter()
+    response = (session or requests).post(BLAST_QUERY_URL, params=blast_params)
+    # an error page says nothing of the search's status, so is not read as UNKNOWN
+    response.raise_for_status()
     response_text = response.text
 
+    status = "UNKNOWN"
     status_block = re.search("Status=(.*)\n", response_text)
     if status_block:
         status = status_block.group(1)
         print(status + "...")
+    _emit_metric("poll", time.perf_counter() - start, RID=RID, status=status)
 
     return status
 
 
-def _fetch_results(RID):
-    """Use RID from search query to retrieve results from web BLAST
-    and convert response text to XML ElementTree object format.
+def _xml_backend(backend=None):
+    """Resolve which XML parser backend to use, falling back to the standard library's
+    ElementTree if lxml is asked for but not installed
+
+    Parameters:
+        backend (str): one of XML_BACKENDS, or None for XML_BACKEND
+
+    Returns:
+        backend (str): "lxml" or "stdlib"
+    """
+    backend = backend or XML_BACKEND
+    if backend == "lxml" and lxml_etree is None:
+        print("lxml is not installed; parsing XML with the standard library instead")
+        return "stdlib"
+
+    return backend
+
+
+def _stream_results(
+    RID, session=None, chunk_size=STREAM_CHUNK_SIZE, backend=None, result_format="XML"
+):
+    """Use RID from search query to retrieve results from web BLAST, parsing them as they are
+    downloaded rather than buffering the whole response first.
 
     Parameters:
         RID (str): RID to identify search query from which to retrieve results
+        session (obj of class requests.Session): HTTP session to use, or None for a new connection
+        chunk_size (int): number of bytes to read off the network at a time
+        backend (str): XML parser to use, one of XML_BACKENDS, or None for XML_BACKEND
+        result_format (str): format to fetch the results in, one of RESULT_FORMATS
 
     Returns:
-        root (obj of class xml.etree.ElementTree): ElementTree object representing full XML data
+        rows (generator): (table, row) tuples, see _rows_from_xml_events; raises
+            requests.HTTPError if web BLAST answers with an HTTP error
     """
     blast_params = {}
     blast_params["CMD"] = "Get"
     blast_params["FORMAT_OBJECT"] = "Alignment"
-    blast_params["FORMAT_TYPE"] = "XML"
+    blast_params["FORMAT_TYPE"] = result_format
     blast_params["RID"] = RID
 
-    response = requests.post(BLAST_QUERY_URL, params=blast_params)
-    response_text = response.text
-    root = ElementTree.fromstring(response_text)
+    http = session or requests
+    if not METRIC_HOOKS:
+        with http.post(BLAST_QUERY_URL, params=blast_params, stream=True) as response:
+            # an error page would otherwise be parsed as results
+            response.raise_for_status()
+            chunks = response.iter_content(chunk_size=chunk_size)
+            yield from _rows_from_result_chunks(chunks, result_format, backend)
+        return
+
+    # downloading and parsing are interleaved, so each is timed by how long it is waited on
+    start = time.perf_counter()
+    with http.post(BLAST_QUERY_URL, params=blast_params, stream=True) as response:
+        response.raise_for_status()
+        headers = time.perf_counter() - start
+        fetch = {"seconds": headers, "bytes": 0}
+        parse = {"seconds": 0, "rows": {}}
+        try:
+            chunks = _metered(response.iter_content(chunk_size=chunk_size), fetch, _tally_bytes)
+            rows = _rows_from_result_chunks(chunks, result_format, backend)
+            yield from _metered(rows, parse, _tally_rows)
+        finally:
+            # time spent waiting on rows includes the time spent waiting on their chunks
+            parse["seconds"] -= fetch["seconds"] - headers
+            _emit_metric("fetch", RID=RID, **fetch)
+            _emit_metric("parse", RID=RID, **parse)
+
+
+async def _submit_query_async(query, session=None, executor=None):
+    """Submit fasta-formatted sequences to web BLAST without blocking the event loop
 
-    return root
+    Parameters
+        query (str): one or more fasta records to search with
+        session (obj of class requests.Session): HTTP session to use, or None for a new connection
+        executor (obj of class concurrent.futures.Executor): executor to submit on, or None
+            for the event loop's default executor
+
+    Returns
+        RID (str): RID of the query submitted to web BLAST
+        RTOE (int): estimated time until search is completed, in seconds; raises _SearchFailed
+            if web BLAST did not return a RID
+    """
+    loop = asyncio.get_running_loop()
+    response_text = await loop.run_in_executor(executor, _submit_sequences, query, session)
+
+    RID, RTOE = _parse_RID_RTOE(response_text)
+    if not RID:
+        raise _SearchFailed(RID, None)
+
+    return RID, RTOE
+
+
+async def _coordinate_polls(
+    polls,
+    wakeup,
+    poll_interval=POLL_INTERVAL,
+    session=None,
+    rate=POLL_RATE,
+    jitter=POLL_JITTER,
+    executor=None,
+):
+    """Check the status of every outstanding RID from a single task, always checking next the
+    RID that is due soonest, i.e. the one expected to be ready first. A RID still 'WAITING' is
+    rescheduled at least poll_interval seconds later; otherwise its future is given its final
+    status. Checks are spaced so that at most rate are made per second in total, however many
+    RIDs are outstanding. A check that fails with a requests.RequestException is retried, see
+    POLL_RETRIES; the RID's future is only given the error once the retries run out. Runs until
+    cancelled.
+
+    Parameters
+        polls (list): heap of (due, RID, future, submitted, waiting, errors) entries, added to
+            with _watch_status; times are event loop times
+        wakeup (obj of class asyncio.Event): set whenever an entry is added to polls
+        poll_interval (float): minimum number of seconds between status checks of one RID
+        session (obj of class requests.Session): HTTP session shared by all status checks
+        rate (float): maximum number of status checks per second, or None for no limit
+        jitter (float): rechecks are delayed by up to this fraction of poll_interval
+        executor (obj of class concurrent.futures.Executor): executor to check statuses on, or
+            None for the event loop's default executor
+
+    Returns
+        None
+    """
+    loop = asyncio.get_running_loop()
+    next_poll = loop.time()
+
+    while True:
+        wakeup.clear()
+        if not polls:
+            await wakeup.wait()
+            continue
+
+        # sleep until the next RID is due, unless an earlier one is added in the meantime
+        delay = max(polls[0][0], next_poll) - loop.time()
+        if delay > 0:
+            try:
+                await asyncio.wait_for(wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        due, RID, future, submitted, waiting, errors = heapq.heappop(polls)
+        if future.done():
+            continue
+        if rate:
+            next_poll = loop.time() + 1 / rate
+
+        try:
+            status = await loop.run_in_executor(executor, _check_status, RID, session)
+        except requests.RequestException as error:
+            if errors >= POLL_RETRIES:
+                future.set_exception(error)
+                continue
+            # a network or server error is usually transient, so the RID is checked again later
+            delay = POLL_RETRY_DELAY * 2**errors
+            print(
+                "Status check of RID {} failed ({}); retrying in {:.0f} seconds".format(
+                    RID, error, delay
+                )
+            )
+            due = loop.time() + delay
+            heapq.heappush(polls, (due, RID, future, submitted, waiting, errors + 1))
+            continue
+        except Exception as error:
+            future.set_exception(error)
+            continue
+
+        if status == "WAITING":
+            waiting = loop.time() - submitted
+            due = loop.time() + poll_interval * (1 + random.uniform(0, jitter))
+            heapq.heappush(polls, (due, RID, future, submitted, waiting, 0))
+        elif not future.done():
+            future.set_result((status, waiting))
+
+
+def _watch_status(polls, wakeup, RID, first_poll=0):
+    """Hand a newly submitted RID to _coordinate_polls
+
+    Parameters
+        polls (list): heap of RIDs being watched by _coordinate_polls
+        wakeup (obj of class asyncio.Event): the coordinator's wakeup event
+        RID (str): the RID of the query to watch
+        first_poll (float): number of seconds to wait before the first status check
+
+    Returns
+        future (obj of class asyncio.Future): resolves once the search is no longer 'WAITING'
+            to its final status ("FAILED", "UNKNOWN", or "READY"), and the seconds from now at
+            which it was last seen 'WAITING', or None if it never was
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    now = loop.time()
+    heapq.heappush(polls, (now + first_poll, RID, future, now, None, 0))
+    wakeup.set()
+
+    return future
+
+
+async def _fetch_results_async(
+    RID, session=None, consume=list, backend=None, result_format="XML", executor=None
+):
+    """Stream and parse the results of a finished search without blocking the event loop
+
+    Parameters
+        RID (str): RID to identify search query from which to retrieve results
+        session (obj of class requests.Session): HTTP session to use, or None for a new connection
+        consume (callable): called, in a worker thread, with the stream of (table, row) tuples
+            as they are parsed; collects them into a list by default
+        backend (str): XML parser to use, one of XML_BACKENDS, or None for XML_BACKEND
+        result_format (str): format to fetch the results in, one of RESULT_FORMATS
+        executor (obj of class concurrent.futures.Executor): executor to fetch on, or None for
+            the event loop's default executor
+
+    Returns
+        result: the return value of consume
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor,
+        lambda: consume(
+            _stream_results(RID, session, backend=backend, result_format=result_format)
+        ),
+    )
 
 
 def _parse_xml_results(root):
@@ -152,170 +862,2388 @@ def _parse_xml_results(root):
     queries = []
     hits = []
     hsps = []
+    start = time.perf_counter()
 
-    for BlastOutput_iteration in root.findall("BlastOutput_iterations"):
-        for iteration in BlastOutput_iteration.findall("Iteration"):
-            # build a tuple consisting of (queryID, queryDef, queryLength)
-            query_data = (
-                iteration.find("Iteration_query-ID").text,
-                iteration.find("Iteration_query-def").text,
-                int(iteration.find("Iteration_query-len").text),
-            )
-            queries.append(query_data)
-
-            for hit in iteration.findall("Iteration_hits/Hit"):
-                # build a tuple consisting of (hitID, hitDef, accession, queryID)
-                hit_data = (
-                    hit.find("Hit_id").text,
-                    hit.find("Hit_def").text,
-                    hit.find("Hit_accession").text,
-                    iteration.find("Iteration_query-ID").text,
-                )
-                hits.append(hit_data)
-
-                for hsp in hit.findall("Hit_hsps/Hsp"):
-                    # build a tuple consisting of:
-                    # (alignmentLength, bitScore, eValue, gaps, percentID, hitID)
-                    hsp_data = (
-                        int(hsp.find("Hsp_align-len").text),
-                        float(hsp.find("Hsp_bit-score").text),
-                        float(hsp.find("Hsp_evalue").text),
-                        int(hsp.find("Hsp_gaps").text),
-                        100
-                        * (
-                            int(hsp.find("Hsp_align-len").text)
-                            / int(iteration.find("Iteration_query-len").text)
-                        ),
-                        hit.find("Hit_id").text,
-                    )
-                    hsps.append(hsp_data)
+    texts = _child_texts
+    if lxml_etree is not None and isinstance(root, lxml_etree._Element):
+        texts = _lxml_child_texts
+
+    for iteration in root.iterfind("BlastOutput_iterations/Iteration"):
+        query_data = _query_row(iteration, texts)
+        queries.append(query_data)
+        query_id, _, query_length = query_data
+
+        for hit in iteration.iterfind("Iteration_hits/Hit"):
+            hit_data = _hit_row(hit, query_id, texts)
+            hits.append(hit_data)
+            hit_id = hit_data[0]
+
+            for hsp in hit.iterfind("Hit_hsps/Hsp"):
+                hsps.append(_hsp_row(hsp, query_length, hit_id, texts))
+
+    rows = {"queries": len(queries), "hits": len(hits), "hsps": len(hsps)}
+    _emit_metric("parse", time.perf_counter() - start, rows=rows)
 
     return queries, hits, hsps
 
 
-def _initialize_database(db_name):
+def _child_texts(elem, tags):
+    """Look up the text of several of an element's children, one findtext() per tag
+
+    Parameters:
+        elem (obj of class xml.etree.ElementTree.Element): parent element
+        tags (tuple): tags of the children to look up
+
+    Returns:
+        texts (tuple): text of each child, in the order of tags; None for any that are missing
     """
-    Create a SQLite database containing queries, hits, and hsps tables
+    return tuple(map(elem.findtext, tags))
+
+
+def _lxml_child_texts(elem, tags):
+    """Version of _child_texts for lxml elements. lxml's findtext() is implemented in Python,
+    so the children are instead picked out by tag in a single C-level pass over them.
 
     Parameters:
-        db_name (str): Name of output SQLite database
+        elem (obj of class lxml.etree._Element): parent element
+        tags (tuple): tags of the children to look up
 
     Returns:
-        bool: True on success, or prints an error and exits the program on Exception
+        texts (tuple): text of each child, in the order of tags; None for any that are missing
     """
-    try:
-        conn = sqlite3.connect(db_name)
+    found = {child.tag: child.text or "" for child in elem.iterchildren(*tags)}
+    return tuple(map(found.get, tags))
 
-        for create in CREATE_STATEMENTS:
-            conn.execute(create)
 
-        conn.commit()
-        conn.close()
+def _query_row(iteration, texts=_child_texts):
+    """Build a (queryID, queryDef, queryLength) tuple from an Iteration element
 
-    except Exception:
-        print("An error occurred when trying to initialize the SQLite database.")
-        sys.exit(1)
+    Parameters:
+        iteration (obj of class xml.etree.ElementTree.Element): Iteration element
+        texts (callable): child text lookup for the parser backend, see _child_texts
 
-    return True
+    Returns:
+        query_data (tuple): row for the queries table
+    """
+    query_id, query_def, query_length = texts(iteration, QUERY_FIELDS)
+    return (query_id, query_def, int(query_length))
 
 
-def _load_results_into_database(db_name, result_data, db_table):
+def _hit_row(hit, query_id, texts=_child_texts):
+    """Build a (hitID, hitDef, accession, queryID) tuple from a Hit element
+
+    Parameters:
+        hit (obj of class xml.etree.ElementTree.Element): Hit element
+        query_id (str): ID of the query that produced the hit
+        texts (callable): child text lookup for the parser backend, see _child_texts
+
+    Returns:
+        hit_data (tuple): row for the hits table
     """
-    Load a dataset into the specified table in SQLite database
+    return texts(hit, HIT_FIELDS) + (query_id,)
 
-    Parameters
-        db_name (str): Name of output SQLite database
-        result_data (list): A list of tuples, each containing a result row to insert into database
-        db_table (str): name of database table into which result_data should be inserted
 
-    Returns
-        bool: True on success, or prints an error and exits the program on Exception
+def _hsp_row(hsp, query_length, hit_id, texts=_child_texts):
+    """Build an (alignmentLength, bitScore, eValue, gaps, percentID, hitID) tuple from an Hsp
 
+    Parameters:
+        hsp (obj of class xml.etree.ElementTree.Element): Hsp element
+        query_length (int): length of the query that produced the hsp
+        hit_id (str): ID of the hit the hsp belongs to
+        texts (callable): child text lookup for the parser backend, see _child_texts
+
+    Returns:
+        hsp_data (tuple): row for the hsps table
     """
-    try:
-        conn = sqlite3.connect(db_name)
+    align_length, bit_score, e_value, gaps = texts(hsp, HSP_FIELDS)
+    align_length = int(align_length)
+    return (
+        align_length,
+        float(bit_score),
+        float(e_value),
+        int(gaps),
+        100 * (align_length / query_length),
+        hit_id,
+    )
 
-        conn.executemany(INSERTS[db_table], result_data)
 
-        conn.commit()
-        conn.close()
+def _rows_from_xml_events(events, texts=_child_texts):
+    """Turn a stream of ("start"/"end", element) XML parser events into result rows.
 
-    except Exception:
-        print("An error occurred when trying to insert data into the {} table".format(db_table))
-        sys.exit(1)
+    Query and hit rows are yielded as soon as their header fields have been read (i.e. before
+    any of their hits/hsps), so consumers always see a parent row before its children. Hsp,
+    Hit and Iteration elements are cleared once they close, so memory use stays flat no matter
+    how large the result document is.
 
-    return True
+    Parameters:
+        events (iterable): (event, element) pairs, as produced by ElementTree.iterparse or
+            ElementTree.XMLPullParser.read_events with events=("start", "end")
+        texts (callable): child text lookup for the parser backend, see _child_texts
 
+    Yields:
+        (table, row) (tuple): name of the table the row belongs in ("queries", "hits" or "hsps")
+            and the row itself, in the same format returned by _parse_xml_results
+    """
+    iteration = hit = None
+    query_data = hit_data = None
+
+    for event, elem in events:
+        tag = elem.tag
+        if event == "start":
+            if tag == "Iteration":
+                iteration, query_data = elem, None
+            elif tag == "Hit":
+                hit, hit_data = elem, None
+            elif tag == "Iteration_hits":
+                query_data = _query_row(iteration, texts)
+                yield "queries", query_data
+            elif tag == "Hit_hsps":
+                hit_data = _hit_row(hit, query_data[0], texts)
+                yield "hits", hit_data
+            continue
+
+        if tag == "Hsp":
+            yield "hsps", _hsp_row(elem, query_data[2], hit_data[0], texts)
+            elem.clear()
+        elif tag == "Hit":
+            if hit_data is None:
+                yield "hits", _hit_row(elem, query_data[0], texts)
+            elem.clear()
+        elif tag == "Iteration":
+            if query_data is None:
+                yield "queries", _query_row(elem, texts)
+            elem.clear()
+
+
+def _iterparse_xml_results(source, backend=None):
+    """Incrementally parse BLAST XML results, yielding rows as each element is completed
 
-def run_blast(fasta_file, output_db_name):
-    """Procedure for BLASTrunner
-        - queries web BLAST with input fasta file
-        - fetches results in XML format when ready
-        - parses XML results
-        - initializes SQLite database
-        - inserts results (queries, hits, and hsps) into SQLite database
+    Parameters:
+        source (str or file object): path to, or binary file object containing, BLAST XML results
+        backend (str): XML parser to use, one of XML_BACKENDS, or None for XML_BACKEND
 
-    Parameters
-        fasta_file (str): fasta file to use for querying web BLAST
-        output_db_name (str): name for local results database
+    Returns:
+        rows (generator): (table, row) tuples, see _rows_from_xml_events
+    """
+    if _xml_backend(backend) == "lxml":
+        events = lxml_etree.iterparse(
+            source, events=("start", "end"), tag=XML_EVENT_TAGS, huge_tree=True
+        )
+        return _rows_from_xml_events(events, _lxml_child_texts)
 
-    Returns
-        None
+    return _rows_from_xml_events(ElementTree.iterparse(source, events=("start", "end")))
+
+
+def _rows_from_xml_chunks(chunks, backend=None):
+    """Incrementally parse BLAST XML results that arrive as a sequence of byte strings
+
+    Parameters:
+        chunks (iterable): successive pieces of a BLAST XML document, e.g. from a streamed response
+        backend (str): XML parser to use, one of XML_BACKENDS, or None for XML_BACKEND
+
+    Returns:
+        rows (generator): (table, row) tuples, see _rows_from_xml_events
     """
-    response_text = _submit_query(fasta_file)
+    backend = _xml_backend(backend)
+    texts = _lxml_child_texts if backend == "lxml" else _child_texts
+    return _rows_from_xml_events(_xml_events_from_chunks(chunks, backend), texts)
 
-    RID, RTOE = _parse_RID_RTOE(response_text)
-    if not RID:
-        print("Something went wrong. Please try search again.")
-        sys.exit(1)
-    if RTOE:
-        print("Sleeping for {} seconds while awaiting results...".format(RTOE))
-        time.sleep(RTOE)
 
-    print("Checking status of web BLAST search: RID {}".format(RID))
-    status = _check_status(RID)
+def _xml_events_from_chunks(chunks, backend=None):
+    """Feed chunks of an XML document into a pull parser, yielding events as they become available
 
-    if status == "FAILED":
-        print("Web BLAST search {} failed.".format(RID))
-        print("Report error at https://support.nlm.nih.gov/support/create-case/")
-        sys.exit(1)
-    if status == "UNKNOWN":
-        print("Web BLAST search {} has expired; try re-running a new search.".format(RID))
-        sys.exit(1)
-    if status == "READY":
-        print("Retrieving results...")
+    Parameters:
+        chunks (iterable): successive pieces of an XML document
+        backend (str): XML parser to use, one of XML_BACKENDS, or None for XML_BACKEND
 
-    root = _fetch_results(RID)
-    queries, hits, hsps = _parse_xml_results(root)
+    Yields:
+        (event, element) (tuple): "start"/"end" parser events
+    """
+    if _xml_backend(backend) == "lxml":
+        parser = lxml_etree.XMLPullParser(
+            events=("start", "end"), tag=XML_EVENT_TAGS, huge_tree=True
+        )
+    else:
+        parser = ElementTree.XMLPullParser(events=("start", "end"))
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from parser.read_events()
 
-    if _initialize_database(output_db_name):
-        print("Initialized SQLite database")
+    parser.close()
+    yield from parser.read_events()
 
-    if _load_results_into_database(output_db_name, queries, "queries"):
-        print("Loaded query data into database")
 
-    if _load_results_into_database(output_db_name, hits, "hits"):
-        print("Loaded hit data into database")
+def _rows_from_result_chunks(chunks, result_format="XML", backend=None):
+    """Incrementally parse a results document in any of RESULT_FORMATS from an iterable of
+    byte chunks, e.g. a streamed HTTP response body
 
-    if _load_results_into_database(output_db_name, hsps, "hsps"):
-        print("Loaded hsp data into database")
+    Parameters:
+        chunks (iterable): successive pieces of the document
+        result_format (str): format of the document, one of RESULT_FORMATS
+        backend (str): XML parser to use for XML, one of XML_BACKENDS, or None for XML_BACKEND
 
-    print("Successfully loaded BLAST results into SQLite database!")
-    print("See README for help with querying local results database")
+    Returns:
+        rows (generator): (table, row) tuples, see _rows_from_xml_events
+    """
+    if result_format == "JSON2_S":
+        return _rows_from_json_chunks(chunks)
+    if result_format == "Tabular":
+        return _rows_from_tabular_chunks(chunks)
 
+    return _rows_from_xml_chunks(chunks, backend)
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("input_file", help="Path to the fasta file to be used to query NCBI BLAST")
-    parser.add_argument(
-        "-o", "--output_db_name", default="blastresults.db", help="name for local results database"
-    )
 
-    args = parser.parse_args()
-    if args.input_file:
+def _rows_from_json_chunks(chunks):
+    """Turn the pieces of a single-file JSON (JSON2_S) results document into result rows. The
+    document holds a report per query in its BlastOutput2 list, and each report is decoded as
+    soon as all of it has arrived, so only one query's results are held in memory at a time.
+
+    Parameters:
+        chunks (iterable): successive pieces of the document
+
+    Yields:
+        (table, row) (tuple): rows in the same order, and format, as _rows_from_xml_events
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = None
+    retry_at = 0
+
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        buffer += text.decode(chunk or b"", final)
+        if position is None:
+            start = JSON_REPORTS_START.search(buffer)
+            if start is None:
+                if final:
+                    raise ValueError("No BlastOutput2 reports found in JSON results")
+                continue
+            position = start.end()
+        if len(buffer) < retry_at and not final:
+            continue
+
+        while True:
+            position = JSON_SEPARATORS.match(buffer, position).end()
+            if buffer.startswith("]", position):
+                return
+            try:
+                report, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if final:
+                    raise
+                # wait for the undecoded text to double before trying again, so that a large
+                # report is not decoded over again for every chunk
+                retry_at = 2 * len(buffer) - position
+                break
+            yield from _rows_from_json_report(report["report"])
+
+        buffer = buffer[position:]
+        retry_at -= position
+        position = 0
+
+
+def _rows_from_json_report(report):
+    """Build the result rows of one query from its report in a JSON2_S document
+
+    Parameters:
+        report (dict): the report, as decoded from the document
+
+    Yields:
+        (table, row) (tuple): rows in the same order, and format, as _rows_from_xml_events
+    """
+    search = report["results"]["search"]
+    query_id = search["query_id"]
+    query_length = search["query_len"]
+    yield "queries", (query_id, search.get("query_title", ""), query_length)
+
+    for hit in search.get("hits", []):
+        first, *others = hit["description"]
+        hit_id = first["id"]
+        # identical sequences merged into one hit are listed in its definition, as BLAST XML
+        # lists them in Hit_def: each after the first preceded by " >" and its ID
+        hit_def = " >".join(
+            [first.get("title", "")]
+            + ["{} {}".format(other["id"], other.get("title", "")) for other in others]
+        )
+        yield "hits", (hit_id, hit_def, first.get("accession", ""), query_id)
+
+        for hsp in hit["hsps"]:
+            align_length = hsp["align_len"]
+            yield "hsps", (
+                align_length,
+                float(hsp["bit_score"]),
+                float(hsp["evalue"]),
+                # BLAST leaves gaps out of an hsp that has none
+                hsp.get("gaps", 0),
+                100 * (align_length / query_length),
+                hit_id,
+            )
+
+
+def _lines_from_chunks(chunks):
+    """Split the pieces of a text document into its lines
+
+    Parameters:
+        chunks (iterable): successive pieces of the document, as bytes
+
+    Yields:
+        line (str): each line, without its line ending
+    """
+    text = codecs.getincrementaldecoder("utf-8")()
+    partial = ""
+    for chunk in chunks:
+        lines = (partial + text.decode(chunk)).split("\n")
+        partial = lines.pop()
+        for line in lines:
+            yield line.rstrip("\r")
+
+    partial += text.decode(b"", True)
+    if partial:
+        yield partial.rstrip("\r")
+
+
+def _rows_from_tabular_chunks(chunks):
+    """Turn the pieces of a Tabular results report into result rows. Each query's part of the
+    report starts with comment lines, whose "# Fields:" line names its columns, followed by a
+    tab-separated line per hsp. Values the report has no column for are left as None. BLAST
+    lists all of a subject's hsps together, so a hit row is yielded whenever the subject changes.
+    Queries are identified by the report's query ID column, which web BLAST fills in with each
+    query's fasta ID, rather than by the Query_ IDs of the other formats.
+
+    Parameters:
+        chunks (iterable): successive pieces of the report
+
+    Yields:
+        (table, row) (tuple): rows in the same order, and format, as _rows_from_xml_events
+    """
+    columns = {}
+    query_def = None
+    query_id = hit_id = None
+
+    for line in _lines_from_chunks(chunks):
+        if "<" in line:
+            # the report comes wrapped in a <PRE> element
+            line = re.sub("<[^>]*>", "", line)
+        if line.startswith("#"):
+            name, _, value = line[1:].partition(":")
+            name = name.strip()
+            if name == "Query":
+                query_def, query_id = value.strip(), None
+            elif name == "Fields":
+                fields = [field.strip() for field in value.split(",")]
+                columns = {
+                    key: next((fields.index(field) for field in names if field in fields), None)
+                    for key, names in TABULAR_COLUMNS.items()
+                }
+            continue
+
+        values = line.split("\t")
+        if len(values) < 2 or not columns:
+            continue
+        row = {key: None if i is None else values[i] for key, i in columns.items()}
+
+        if row["queryID"] != query_id:
+            query_id, hit_id = row["queryID"], None
+            query_length = row["queryLength"] and int(row["queryLength"])
+            yield "queries", (query_id, row["queryDef"] or query_def, query_length)
+
+        if row["hitID"] != hit_id:
+            hit_id = row["hitID"]
+            accession = row["accession"] and re.sub(r"\.\d+$", "", row["accession"])
+            yield "hits", (hit_id, row["hitDef"], accession, query_id)
+
+        align_length = int(row["alignLength"])
+        yield "hsps", (
+            align_length,
+            float(row["bitScore"]),
+            float(row["eValue"]),
+            row["gaps"] and int(row["gaps"]),
+            100 * (align_length / query_length) if query_length else None,
+            hit_id,
+        )
+
+
+def _parse_xml_file_parallel(xml_file, workers=None, backend=None, scan=False):
+    """Parse a BLAST XML results file on several processes at once. The file is split at
+    Iteration boundaries into ranges of similar size, no larger than PARSE_RANGE_SIZE, which
+    worker processes parse independently; their rows are yielded in document order. Only a
+    few ranges are parsed ahead of the one being yielded, so memory use stays bounded however
+    large the file is. The rest of the document, around its Iterations, is parsed in this
+    process, and a file without any Iterations is parsed whole, so that a file that is not
+    well-formed fails just as it does when read in one process.
+
+    Parameters:
+        xml_file (str): path to a BLAST XML results file
+        workers (int): number of worker processes, or None for one per CPU
+        backend (str): XML parser to use, one of XML_BACKENDS, or None for XML_BACKEND
+        scan (bool): extract rows with _scan_xml_results rather than parsing the XML
+
+    Yields:
+        (table, row) (tuple): rows in the same order as _iterparse_xml_results yields them
+    """
+    workers = workers or os.cpu_count()
+    backend = _xml_backend(backend)
+    with open(xml_file, "rb") as xml, mmap.mmap(xml.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        count = max(workers * 4, math.ceil(len(data) / PARSE_RANGE_SIZE))
+        ranges = _iteration_ranges(data, count)
+        if ranges and not scan:
+            outside = data[: ranges[0][0]] + data[ranges[-1][1] :]
+
+    if not ranges:
+        # nothing to split, e.g. an error page saved in place of the results
+        yield from _ingest_xml_file(xml_file, backend, scan)
+        return
+    if not scan:
+        for row in _rows_from_xml_chunks([outside], backend):
+            pass
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for start, end in ranges:
+            futures.append(
+                executor.submit(_parse_iteration_range, xml_file, start, end, backend, scan)
+            )
+            if len(futures) > workers * 2:
+                yield from futures.pop(0).result()
+        for future in futures:
+            yield from future.result()
+
+
+def _iteration_ranges(data, count):
+    """Find byte ranges that split the Iteration elements of a BLAST XML document into about
+    count groups of similar size, by scanning for the Iteration start tags
+
+    Parameters:
+        data (bytes or mmap): the BLAST XML document
+        count (int): number of ranges to aim for
+
+    Returns:
+        ranges (list): (start, end) byte offsets, each spanning one or more whole Iterations
+    """
+    starts = []
+    position = data.find(b"<Iteration>")
+    while position != -1:
+        starts.append(position)
+        position = data.find(b"<Iteration>", position + 1)
+    if not starts:
+        return []
+
+    end = data.rfind(b"</BlastOutput_iterations>")
+    if end == -1:
+        # a truncated document; its last range fails to parse
+        end = len(data)
+    target_size = (end - starts[0]) / count
+
+    ranges = []
+    range_start = starts[0]
+    for start in starts[1:]:
+        if start - range_start >= target_size:
+            ranges.append((range_start, start))
+            range_start = start
+    ranges.append((range_start, end))
+
+    return ranges
+
+
+def _parse_iteration_range(xml_file, start, end, backend=None, scan=False):
+    """Parse one byte range of whole Iterations out of a BLAST XML results file; run in a
+    worker process by _parse_xml_file_parallel
+
+    Parameters:
+        xml_file (str): path to a BLAST XML results file
+        start (int): byte offset of the first Iteration in the range
+        end (int): byte offset just past the last Iteration in the range
+        backend (str): XML parser to use, one of XML_BACKENDS, or None for XML_BACKEND
+        scan (bool): extract rows with _scan_xml_results rather than parsing the XML
+
+    Returns:
+        rows (list): (table, row) tuples of the Iterations in the range
+    """
+    with open(xml_file, "rb") as xml:
+        xml.seek(start)
+        iterations = xml.read(end - start)
+
+    try:
+        if scan:
+            return list(_scan_xml_results(iterations))
+
+        document = [b"<BlastOutput_iterations>", iterations, b"</BlastOutput_iterations>"]
+        return list(_rows_from_xml_chunks(document, backend))
+    except INGEST_ERRORS as error:
+        # parser errors, lxml's in particular, cannot always be sent back to the parent process
+        raise ValueError("{}: {}".format(type(error).__name__, error)) from None
+
+
+def _scan_xml_file(xml_file):
+    """Scan a BLAST XML results file for result rows, see _scan_xml_results. The file is
+    memory-mapped rather than read in, so it is paged in by the OS as it is scanned.
+
+    Parameters:
+        xml_file (str): path to a BLAST XML results file
+
+    Yields:
+        (table, row) (tuple): rows in the same order as _iterparse_xml_results yields them
+    """
+    with open(xml_file, "rb") as xml, mmap.mmap(xml.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        yield from _scan_xml_results(data)
+
+
+def _scan_xml_results(data):
+    """Extract result rows from BLAST XML by scanning its bytes for the few elements that are
+    kept, without parsing the document or building any elements. The sequences and alignment
+    midlines that make up most of each Hsp are skipped over in C by the regular expression
+    engine.
+
+    Unlike the XML parsers, the scanner does not check that the document is well-formed, so it
+    is meant for ingesting BLAST's own output; it relies on the queries, hits, and hsps fields
+    appearing in the order BLAST's DTD lays them out.
+
+    Parameters:
+        data (bytes or mmap): a BLAST XML document
+
+    Yields:
+        (table, row) (tuple): rows in the same order as _iterparse_xml_results yields them
+    """
+    fields = {}
+    query_data = hit_data = None
+    for match in XML_SCAN_PATTERN.finditer(data):
+        tag = match[1]
+        if tag is None:
+            # </Hsp>
+            align_length = int(fields[b"Hsp_align-len"])
+            yield "hsps", (
+                align_length,
+                float(fields[b"Hsp_bit-score"]),
+                float(fields[b"Hsp_evalue"]),
+                int(fields[b"Hsp_gaps"]),
+                100 * (align_length / query_data[2]),
+                hit_data[0],
+            )
+            fields = {}
+            continue
+
+        fields[tag] = match[2]
+        if tag == b"Iteration_query-len":
+            query_data = (
+                _scanned_text(fields[b"Iteration_query-ID"]),
+                _scanned_text(fields[b"Iteration_query-def"]),
+                int(match[2]),
+            )
+            yield "queries", query_data
+            fields = {}
+        elif tag == b"Hit_accession":
+            hit_data = (
+                _scanned_text(fields[b"Hit_id"]),
+                _scanned_text(fields[b"Hit_def"]),
+                _scanned_text(match[2]),
+                query_data[0],
+            )
+            yield "hits", hit_data
+            fields = {}
+
+
+def _ingest_xml_file(xml_file, xml_backend=None, scan=False, workers=None):
+    """Read result rows out of a BLAST XML results file on disk. The file is memory-mapped and
+    parsed incrementally, so it is never read into memory as a whole.
+
+    Parameters:
+        xml_file (str): path to a BLAST XML results file, e.g. from blastn -outfmt 5
+        xml_backend (str): XML parser to use, one of XML_BACKENDS, or None for XML_BACKEND
+        scan (bool): extract rows with _scan_xml_results rather than parsing the XML
+        workers (int): number of processes to split the file between, see
+            _parse_xml_file_parallel, or None to read it in this process
+
+    Yields:
+        (table, row) (tuple): rows in the same order as _iterparse_xml_results yields them
+    """
+    if workers:
+        yield from _parse_xml_file_parallel(xml_file, workers, xml_backend, scan)
+        return
+
+    if scan:
+        yield from _scan_xml_file(xml_file)
+        return
+
+    with open(xml_file, "rb") as xml, mmap.mmap(xml.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        yield from _iterparse_xml_results(data, xml_backend)
+
+
+def _expand_xml_paths(paths):
+    """Find the BLAST XML files named by a list of paths
+
+    Parameters
+        paths (list): files; directories, which are searched recursively for *.xml files; or
+            glob patterns, which may use ** to match any number of directories
+
+    Returns
+        xml_files (list): paths of the files found, each listed once
+    """
+    xml_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            xml_files.extend(
+                sorted(glob.glob(os.path.join(glob.escape(path), "**", "*.xml"), recursive=True))
+            )
+        elif glob.has_magic(path):
+            xml_files.extend(sorted(glob.glob(path, recursive=True)))
+        else:
+            xml_files.append(path)
+
+    return list(dict.fromkeys(xml_files))
+
+
+def _read_xml_files(xml_files, db_name, xml_backend=None, scan=False, failed=None, workers=None):
+    """Read the result rows of several BLAST XML files in turn, skipping over any file that
+    cannot be read, or whose queries clash with those already stored
+
+    Parameters
+        xml_files (list): paths of BLAST XML results files
+        db_name (str): Name of the output SQLite database the rows are loaded into, to check
+            their queries against, see _check_stored_queries
+        xml_backend (str): XML parser to use, one of XML_BACKENDS, or None for XML_BACKEND
+        scan (bool): extract rows with _scan_xml_results rather than parsing the XML
+        failed (list): paths of files that could not be read are appended to this list
+        workers (int): number of processes to split each file between, or None to read them
+            in this process
+
+    Yields
+        (table, row) (tuple): the rows of each file, see _rows_from_xml_events, between
+            ("begin", xml_file) and ("end", xml_file) markers, or ("rollback", xml_file) if the
+            file fails partway through, so that _bulk_load_results loads each file in a
+            transaction of its own
+    """
+    with contextlib.closing(sqlite3.connect(db_name)) as stored:
+        for number, xml_file in enumerate(xml_files, 1):
+            parse = {"seconds": 0, "rows": {}}
+            rows = _ingest_xml_file(xml_file, xml_backend, scan, workers)
+            if METRIC_HOOKS:
+                rows = _metered(rows, parse, _tally_rows)
+            yield "begin", xml_file
+            try:
+                yield from _check_stored_queries(rows, stored)
+            except INGEST_ERRORS as error:
+                _report_failed_file(xml_file, error, failed)
+                yield "rollback", xml_file
+                continue
+            yield "end", xml_file
+            _emit_metric("parse", file=xml_file, **parse)
+            print("Read file {} of {}: {}".format(number, len(xml_files), xml_file))
+
+
+def _read_xml_files_parallel(
+    xml_files, db_name, workers, xml_backend=None, scan=False, batch_size=BATCH_SIZE, failed=None
+):
+    """Read the result rows of several BLAST XML files, parsing them in a pool of worker
+    processes. Workers send their rows back over a bounded queue in batches of whole queries,
+    and one file's rows are loaded as they are parsed rather than once the whole file has been
+    read. Since each file is loaded in a transaction of its own, the batches other files send
+    in the meantime are set aside in spool files, and loaded once that file is done. Files
+    that cannot be read, or whose queries clash with those already stored, are skipped, and the
+    rows already loaded from them rolled back.
+
+    Parameters
+        xml_files (list): paths of BLAST XML results files
+        db_name (str): Name of the output SQLite database the rows are loaded into, to check
+            their queries against, see _check_stored_queries
+        workers (int): number of worker processes
+        xml_backend (str): XML parser to use, one of XML_BACKENDS, or None for XML_BACKEND
+        scan (bool): extract rows with _scan_xml_results rather than parsing the XML
+        batch_size (int): number of rows per batch sent by a worker, or None for BATCH_SIZE
+        failed (list): paths of files that could not be read are appended to this list
+
+    Yields
+        (table, row) (tuple): the rows of each file, see _read_xml_files
+    """
+    messages = multiprocessing.Queue(maxsize=workers * 2)
+    with tempfile.TemporaryDirectory() as spool_dir, concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_ingest_worker, initargs=(messages,)
+    ) as executor:
+        futures = {}
+        for index, xml_file in enumerate(xml_files):
+            try:
+                future = executor.submit(
+                    _queue_xml_file, index, xml_file, xml_backend, scan, batch_size or BATCH_SIZE
+                )
+            except concurrent.futures.process.BrokenProcessPool as error:
+                # a worker process died before every file was handed out; the files left over
+                # fail as those already handed out do, below
+                future = concurrent.futures.Future()
+                future.set_exception(error)
+            futures[future] = index
+        remaining = set(futures.values())
+        spools = {index: os.path.join(spool_dir, str(index)) for index in remaining}
+        # the file whose rows are being loaded, and those read in full while it was
+        current = None
+        finished = []
+
+        def report_read(index):
+            number = len(xml_files) - len(remaining) - len(finished)
+            print("Read file {} of {}: {}".format(number, len(xml_files), xml_files[index]))
+
+        stored = sqlite3.connect(db_name)
+        try:
+            while remaining or finished:
+                if current is None and finished:
+                    index = finished.pop(0)
+                    yield "begin", xml_files[index]
+                    try:
+                        yield from _check_stored_queries(_read_spool(spools[index]), stored)
+                    except ValueError as error:
+                        _report_failed_file(xml_files[index], error, failed)
+                        yield "rollback", xml_files[index]
+                        continue
+                    yield "end", xml_files[index]
+                    report_read(index)
+                    continue
+
+                try:
+                    received = [messages.get(timeout=1)]
+                except queue.Empty:
+                    # a worker process that died never reports on its file, and breaks the pool,
+                    # failing every file not yet read with BrokenProcessPool
+                    received = [
+                        ("failed", index, future.exception())
+                        for future, index in futures.items()
+                        if index in remaining and future.done() and future.exception()
+                    ]
+
+                for kind, index, content in received:
+                    if index not in remaining:
+                        continue
+                    if kind == "rows" and current not in (None, index):
+                        with open(spools[index], "ab") as spool:
+                            pickle.dump(content, spool)
+                        continue
+                    if kind == "rows":
+                        try:
+                            if current is None:
+                                current = index
+                                yield "begin", xml_files[index]
+                                yield from _check_stored_queries(_read_spool(spools[index]), stored)
+                            yield from _check_stored_queries(content, stored)
+                            continue
+                        except ValueError as error:
+                            # the rest of the file's rows are ignored as they arrive
+                            kind, content = "failed", error
+
+                    remaining.discard(index)
+                    if kind == "failed":
+                        _report_failed_file(xml_files[index], content, failed)
+                        if index == current:
+                            yield "rollback", xml_files[index]
+                            current = None
+                        elif os.path.exists(spools[index]):
+                            os.remove(spools[index])
+                    elif index == current:
+                        yield "end", xml_files[index]
+                        current = None
+                        report_read(index)
+                    else:
+                        finished.append(index)
+        finally:
+            stored.close()
+            # if loading stopped early, drain the queue so busy workers are not left blocked
+            # on it and can exit
+            executor.shutdown(wait=False, cancel_futures=True)
+            while not all(future.done() for future in futures):
+                try:
+                    messages.get(timeout=1)
+                except queue.Empty:
+                    pass
+
+
+def _spool_rows(rows, spool_file, batch_size=BATCH_SIZE):
+    """Set rows aside in a spool file, batch_size at a time, to be read back with _read_spool
+
+    Parameters
+        rows (iterable): (table, row) tuples
+        spool_file (str): path of the spool file, which is appended to
+        batch_size (int): number of rows held in memory and written at a time
+
+    Returns
+        None
+    """
+    rows = iter(rows)
+    with open(spool_file, "ab") as spool:
+        for batch in iter(lambda: list(itertools.islice(rows, batch_size)), []):
+            pickle.dump(batch, spool)
+
+
+def _read_spool(spool_file):
+    """Read back, and remove, the batches of rows set aside for a file by
+    _read_xml_files_parallel, or for a search by run_blast_async
+
+    Parameters
+        spool_file (str): path of the spool file, which need not exist
+
+    Yields
+        (table, row) (tuple): the rows of the batches, in the order they were set aside
+    """
+    if not os.path.exists(spool_file):
+        return
+    with open(spool_file, "rb") as spool:
+        while True:
+            try:
+                yield from pickle.load(spool)
+            except EOFError:
+                break
+    os.remove(spool_file)
+
+
+def _init_ingest_worker(messages):
+    """Set up a worker process of _read_xml_files_parallel
+
+    Parameters
+        messages (obj of class multiprocessing.Queue): queue of messages to the writer
+
+    Returns
+        None
+    """
+    global _ingest_messages
+    _ingest_messages = messages
+
+
+def _queue_xml_file(index, xml_file, xml_backend, scan, batch_size):
+    """Read the result rows of one BLAST XML file and send them to the writer; run in a worker
+    process by _read_xml_files_parallel. Rows are sent in ("rows", index, rows) messages
+    holding batch_size or more rows, cut only where a new query begins, followed by either
+    ("done", index, None) or ("failed", index, error).
+
+    Parameters
+        index (int): position of the file in the list being read
+        xml_file (str): path to a BLAST XML results file
+        xml_backend (str): XML parser to use, one of XML_BACKENDS
+        scan (bool): extract rows with _scan_xml_results rather than parsing the XML
+        batch_size (int): minimum number of rows per message
+
+    Returns
+        None
+    """
+    batch = []
+    try:
+        for table, row in _ingest_xml_file(xml_file, xml_backend, scan):
+            if table == "queries" and len(batch) >= batch_size:
+                _ingest_messages.put(("rows", index, batch))
+                batch = []
+            batch.append((table, row))
+    except INGEST_ERRORS as error:
+        _ingest_messages.put(("rows", index, batch))
+        _ingest_messages.put(("failed", index, "{}: {}".format(type(error).__name__, error)))
+        return
+
+    _ingest_messages.put(("rows", index, batch))
+    _ingest_messages.put(("done", index, None))
+
+
+def _report_failed_file(xml_file, error, failed):
+    """Report a BLAST XML file that could not be read during ingest
+
+    Parameters
+        xml_file (str): path of the file
+        error (Exception or str): what went wrong
+        failed (list): list of failed files to add xml_file to, or None
+
+    Returns
+        None
+    """
+    print("Could not read BLAST XML results from {}: {}".format(xml_file, error))
+    if failed is not None:
+        failed.append(xml_file)
+
+
+def _check_stored_queries(rows, conn):
+    """Pass result rows through, making sure none of their queries is already stored as another
+    query. Standalone BLAST numbers the queries of every run Query_1, Query_2, and so on, so
+    the same queryID in results of unrelated runs names different sequences, which must not be
+    merged. A query stored with the same definition and length is the same query loaded again.
+
+    Parameters
+        rows (iterable): (table, row) tuples, e.g. from _iterparse_xml_results
+        conn (obj of class sqlite3.Connection): connection to the output SQLite database
+
+    Yields
+        (table, row) (tuple): the rows, unchanged; raises ValueError at the first query whose
+            stored definition or length differs from its own
+    """
+    for table, row in rows:
+        if table == "queries":
+            stored = conn.execute(
+                "SELECT queryDef, queryLength FROM queries WHERE queryID = ?", (row[0],)
+            ).fetchone()
+            # values the stored results did not carry, e.g. Tabular's query lengths, are unknown
+            if stored and any(old not in (None, new) for old, new in zip(stored, row[1:])):
+                raise ValueError(
+                    "query {} is already loaded with a different definition or length, from "
+                    "other results; load these into another database".format(row[0])
+                )
+        yield table, row
+
+
+def _scanned_text(value):
+    """Decode the raw text of an element found by _scan_xml_results
+
+    Parameters:
+        value (bytes): UTF-8 element text, possibly containing XML character references, or
+            None for an empty element
+
+    Returns:
+        text (str): the element's text, as an XML parser would report it
+    """
+    if value is None:
+        return ""
+
+    text = value.decode()
+    if "&" in text:
+        text = html.unescape(text)
+
+    return text
+
+
+def _collect_results(rows):
+    """Gather streamed (table, row) tuples back into the lists returned by _parse_xml_results
+
+    Parameters:
+        rows (iterable): (table, row) tuples, e.g. from _iterparse_xml_results
+
+    Returns:
+        queries (list): a list of tuples containing information about each query performed
+        hits (list): a list of tuples containing information about each hit returned from BLAST
+        hsps (list): a list of tuples containing information about each hsp returned from BLAST
+    """
+    results = {"queries": [], "hits": [], "hsps": []}
+    for table, row in rows:
+        results[table].append(row)
+
+    return results["queries"], results["hits"], results["hsps"]
+
+
+class _SearchFailed(Exception):
+    """Raised by a search that did not complete, with its RID and final status as args; both
+    are empty for a search web BLAST did not accept"""
+
+
+class _LedgerFailed(Exception):
+    """Raised when a job ledger could not be updated, with the name of its database as args"""
+
+
+def _exit_on_failed_status(RID, status):
+    """Report a web BLAST search that did not complete and exit the program
+
+    Parameters
+        RID (str): RID of the search, or "" if it was not accepted
+        status (str): final status reported by BLAST ("FAILED" or "UNKNOWN"), or None if the
+            search was not accepted
+
+    Returns
+        None; prints an error and exits the program
+    """
+    if not RID:
+        print("Something went wrong. Please try search again.")
+    elif status == "FAILED":
+        print("Web BLAST search {} failed.".format(RID))
+        print("Report error at https://support.nlm.nih.gov/support/create-case/")
+    else:
+        print("Web BLAST search {} has expired; try re-running a new search.".format(RID))
+    sys.exit(1)
+
+
+async def _run_searches(
+    queries,
+    max_in_flight=4,
+    submit_interval=SUBMIT_INTERVAL,
+    poll_interval=POLL_INTERVAL,
+    session=None,
+    consume=None,
+    xml_backend=None,
+    poll_history=None,
+    poll_rate=POLL_RATE,
+    ledger=None,
+    resume=False,
+    result_format="XML",
+):
+    """Run several web BLAST searches concurrently, keeping at most max_in_flight RIDs
+    outstanding at a time. Submissions are spaced at least submit_interval seconds apart,
+    each RID is first checked once its RTOE has elapsed and then at most once every
+    poll_interval seconds, and results are fetched as soon as a search is READY. Status checks
+    of all RIDs are made by one coordinator, no more than poll_rate per second. Results are
+    fetched on a pool of max_in_flight threads, and submissions and status checks on a pool of
+    their own, so that neither waits for a thread behind the other.
+
+    Given a poll_history file, how long each search took is recorded there, and the first
+    check of each RID is instead scheduled from how long similar searches took before, so
+    that searches BLAST finishes sooner than its RTOE are fetched sooner.
+
+    Given a ledger database, each search's RID and progress are recorded in its jobs table as
+    the search goes. With resume, searches the ledger has as DONE are skipped, and searches
+    that were still WAITING or READY are checked on and fetched again by their recorded RID
+    instead of being resubmitted, unless web BLAST no longer knows the RID (e.g. its results
+    have expired), in which case they are submitted again.
+
+    By default each search's rows are collected into a list. Given consume, each search's rows
+    are instead handed to consume(index, rows) as they are parsed off the network, in a worker
+    thread, so they can be processed without ever being held in memory all at once.
+
+    Parameters
+        queries (list): fasta-formatted query strings, one per search
+        max_in_flight (int): maximum number of searches to have submitted but not yet fetched
+        submit_interval (float): minimum number of seconds between submissions
+        poll_interval (float): minimum number of seconds between status checks of one RID
+        session (obj of class requests.Session): HTTP session shared by all searches
+        consume (callable): consumer of each search's (table, row) tuples, or None
+        xml_backend (str): XML parser to use, one of XML_BACKENDS, or None for XML_BACKEND
+        poll_history (str): path to the poll history file, or None to check at RTOE
+        poll_rate (float): maximum number of status checks per second, or None for no limit
+        ledger (str): name of the SQLite database holding the job ledger (see _ledger_path), or
+            None for none
+        resume (bool): pick up the searches recorded in the ledger by an earlier run
+        result_format (str): format to fetch results in, one of RESULT_FORMATS
+
+    Returns
+        results (list): for each query, in order, a list of its (table, row) tuples, or the
+            return value of consume; None for searches skipped as already DONE
+    """
+    loop = asyncio.get_running_loop()
+    in_flight = asyncio.Semaphore(max_in_flight)
+    submit_lock = asyncio.Lock()
+    next_submit = loop.time()
+    history = _read_poll_history(poll_history) if poll_history else []
+    polls = []
+    wakeup = asyncio.Event()
+    jobs = _read_jobs(ledger) if ledger and resume else {}
+    # fetches download, parse, and load results, taking turns to load, so can hold a thread for
+    # a long time; they get threads of their own, so status checks and submissions, which are
+    # made one at a time, never wait behind them for one
+    fetch_pool = concurrent.futures.ThreadPoolExecutor(max_in_flight, "blast-fetch")
+    request_pool = concurrent.futures.ThreadPoolExecutor(2, "blast-request")
+
+    async def run_search(index, query):
+        nonlocal next_submit
+        key = _cache_key(query, result_format)
+        job = jobs.get(key, {})
+        if job.get("status") == "DONE":
+            print(
+                "Search {} of {} already loaded: RID {}".format(index + 1, len(queries), job["RID"])
+            )
+            return None
+
+        async with in_flight:
+            length = _sequence_length(query)
+            resumed = job.get("status") in RESUMABLE_STATUSES
+            if resumed:
+                RID = job["RID"]
+                first_poll = max(0, job["submitted"] + job["RTOE"] - time.time())
+                print("Search {} of {} resumed: RID {}".format(index + 1, len(queries), RID))
+                status, waiting = await _watch_status(polls, wakeup, RID, first_poll)
+                if status == "UNKNOWN":
+                    # web BLAST has expired the search, so its records are searched again
+                    print(
+                        "Search {} of {} has expired: RID {}".format(index + 1, len(queries), RID)
+                    )
+                    if ledger:
+                        await asyncio.to_thread(_drop_job, ledger, key)
+                    resumed = False
+
+            if not resumed:
+                async with submit_lock:
+                    await asyncio.sleep(next_submit - loop.time())
+                    RID, RTOE = await _submit_query_async(query, session, request_pool)
+                    submitted = next_submit = loop.time()
+                    next_submit += submit_interval
+                print("Search {} of {} submitted: RID {}".format(index + 1, len(queries), RID))
+                if ledger:
+                    await asyncio.to_thread(
+                        _record_job,
+                        ledger,
+                        key,
+                        RID=RID,
+                        submitted=time.time(),
+                        RTOE=RTOE,
+                        status="WAITING",
+                        records=" ".join(
+                            _cache_key(record, result_format) for record in _split_fasta(query)
+                        ),
+                    )
+
+                first_poll = RTOE
+                if poll_history:
+                    first_poll = _predict_first_poll(history, RTOE, length)
+                    first_poll *= random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+                    print("Checking status of RID {} in {:.0f} seconds".format(RID, first_poll))
+
+                status, waiting = await _watch_status(polls, wakeup, RID, first_poll)
+                _emit_metric("wait", loop.time() - submitted, RID=RID, status=status)
+
+            if ledger:
+                await asyncio.to_thread(_record_job, ledger, key, status=status)
+            if status != "READY":
+                raise _SearchFailed(RID, status)
+
+            # resumed searches were partly waited on by an earlier run, so are not comparable
+            if poll_history and not resumed:
+                entry = {
+                    "program": BLAST_PROGRAM,
+                    "database": BLAST_DATABASE,
+                    "length": length,
+                    "RTOE": RTOE,
+                    "first": first_poll,
+                    "waiting": waiting,
+                    "ready": loop.time() - submitted,
+                }
+                _record_poll_history(poll_history, history, entry)
+
+            print("Retrieving results for RID {}...".format(RID))
+            if consume is None:
+                result = await _fetch_results_async(
+                    RID,
+                    session,
+                    backend=xml_backend,
+                    result_format=result_format,
+                    executor=fetch_pool,
+                )
+            else:
+                result = await _fetch_results_async(
+                    RID,
+                    session,
+                    lambda rows: consume(index, rows),
+                    xml_backend,
+                    result_format,
+                    fetch_pool,
+                )
+            if ledger:
+                await asyncio.to_thread(_record_job, ledger, key, status="DONE")
+
+            return result
+
+    coordinator = asyncio.create_task(
+        _coordinate_polls(polls, wakeup, poll_interval, session, poll_rate, executor=request_pool)
+    )
+    searches = [asyncio.create_task(run_search(i, query)) for i, query in enumerate(queries)]
+    try:
+        return await asyncio.gather(*searches)
+    except Exception as error:
+        # stop the other searches before exiting, rather than leaving them running in the loop
+        for search in searches:
+            search.cancel()
+        await asyncio.gather(*searches, return_exceptions=True)
+        if isinstance(error, _SearchFailed):
+            _exit_on_failed_status(*error.args)
+        if isinstance(error, _LedgerFailed):
+            print("An error occurred when trying to update the job ledger in the SQLite database.")
+            sys.exit(1)
+        raise
+    finally:
+        coordinator.cancel()
+        fetch_pool.shutdown(wait=False)
+        request_pool.shutdown(wait=False)
+
+
+def _read_poll_history(history_file):
+    """Load the record of how long earlier web BLAST searches took
+
+    Parameters
+        history_file (str): path to the poll history file
+
+    Returns
+        history (list): one dict per finished search, oldest first; empty if there is no
+            readable history
+    """
+    try:
+        with open(history_file) as history:
+            return json.load(history)
+    except (OSError, ValueError):
+        return []
+
+
+def _record_poll_history(history_file, history, entry):
+    """Add a finished search to the poll history and save it
+
+    Parameters
+        history_file (str): path to the poll history file
+        history (list): the poll history, from _read_poll_history; entry is appended to it
+        entry (dict): the search's program, database, query length, and RTOE, and the seconds
+            after submission at which it was first checked, last seen WAITING (None if never),
+            and first seen READY
+
+    Returns
+        None
+    """
+    history.append(entry)
+    del history[:-POLL_HISTORY_SIZE]
+    _replace_file(history_file, lambda out: json.dump(history, out))
+
+
+def _predict_first_poll(history, RTOE, query_length):
+    """Decide when to first check on a search, as a fraction of its RTOE, from how the first
+    checks of the most recent searches with the same program and database, and preferably a
+    similar query length (within a factor of two), went.
+
+    Checking too late delays fetching the results, while checking too early costs a further
+    wait of at least POLL_INTERVAL. So each earlier search suggests the fraction of RTOE at
+    which its first check was made, moved later if that check found it still WAITING and
+    earlier if not; the steps balance out once POLL_MISS_TARGET of first checks find a search
+    still running. The suggestions of up to POLL_HISTORY_RECENT searches are averaged.
+
+    Parameters
+        history (list): the poll history, from _read_poll_history
+        RTOE (int): web BLAST's estimate of the time until the search is completed, in seconds
+        query_length (int): total length of the sequences searched
+
+    Returns
+        first_poll (float): seconds to wait before checking the search's status; RTOE if fewer
+            than POLL_HISTORY_MIN similar searches have been recorded
+    """
+    similar = [
+        entry
+        for entry in history
+        if entry["program"] == BLAST_PROGRAM
+        and entry["database"] == BLAST_DATABASE
+        and entry["RTOE"] > 0
+        and entry["first"] > 0
+    ]
+    same_length = [
+        entry for entry in similar if entry["length"].bit_length() == query_length.bit_length()
+    ]
+    if len(same_length) >= POLL_HISTORY_MIN:
+        similar = same_length
+    if len(similar) < POLL_HISTORY_MIN:
+        return RTOE
+
+    suggestions = [
+        math.log(entry["first"] / entry["RTOE"])
+        + POLL_STEP * ((entry["waiting"] is not None) - POLL_MISS_TARGET)
+        for entry in similar[-POLL_HISTORY_RECENT:]
+    ]
+    return RTOE * math.exp(statistics.mean(suggestions))
+
+
+def _ledger_path(db_name):
+    """Locate the job ledger of an output database
+
+    Parameters
+        db_name (str): Name of output SQLite database
+
+    Returns
+        ledger (str): name of the SQLite database holding its job ledger
+    """
+    return db_name + ".jobs"
+
+
+def _read_jobs(db_name):
+    """Load a job ledger
+
+    Parameters
+        db_name (str): Name of the ledger's SQLite database, from _ledger_path
+
+    Returns
+        jobs (dict): RID, submitted (Unix time), RTOE, and status of each search in the
+            ledger, keyed by jobKey; empty if there is no ledger
+    """
+    try:
+        conn = sqlite3.connect(db_name)
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute("SELECT * FROM jobs").fetchall()
+        conn.close()
+    except sqlite3.Error:
+        return {}
+
+    return {row["jobKey"]: dict(row) for row in rows}
+
+
+def _record_job(db_name, key, **fields):
+    """Add a search to a job ledger, or update its entry
+
+    Parameters
+        db_name (str): Name of the ledger's SQLite database, from _ledger_path
+        key (str): jobKey of the search, from _cache_key
+        fields: values of the jobs table's RID, submitted, RTOE, status, and records columns
+            to set
+
+    Returns
+        None; raises _LedgerFailed on a database error
+    """
+    assignments = ", ".join("{} = ?".format(column) for column in fields)
+    try:
+        conn = sqlite3.connect(db_name, timeout=LEDGER_TIMEOUT)
+        with conn:
+            conn.execute(CREATE_JOBS_TABLE)
+            conn.execute("INSERT OR IGNORE INTO jobs(jobKey) VALUES (?)", (key,))
+            conn.execute(
+                "UPDATE jobs SET {} WHERE jobKey = ?".format(assignments),
+                tuple(fields.values()) + (key,),
+            )
+        conn.close()
+
+    except sqlite3.Error as error:
+        # raised rather than exiting here, in a worker thread, so the other searches are stopped
+        raise _LedgerFailed(db_name) from error
+
+
+def _drop_job(db_name, key):
+    """Remove a search from a job ledger
+
+    Parameters
+        db_name (str): Name of the ledger's SQLite database, from _ledger_path
+        key (str): jobKey of the search, from _cache_key
+
+    Returns
+        None; raises _LedgerFailed on a database error
+    """
+    try:
+        conn = sqlite3.connect(db_name, timeout=LEDGER_TIMEOUT)
+        with conn:
+            conn.execute("DELETE FROM jobs WHERE jobKey = ?", (key,))
+        conn.close()
+
+    except sqlite3.Error as error:
+        # raised rather than exiting here, in a worker thread, so the other searches are stopped
+        raise _LedgerFailed(db_name) from error
+
+
+def _ledger_chunks(jobs, keys):
+    """Find the fasta records that the searches in a job ledger were made with
+
+    Parameters
+        jobs (dict): the job ledger, as returned by _read_jobs
+        keys (list): cache key of each fasta record of the run being resumed, from _cache_key
+
+    Returns
+        chunks (list): one list of record indices per search that is WAITING, READY, or DONE,
+            in the order they were submitted, leaving out searches made with any record the
+            run does not have, or that is already in an earlier search
+    """
+    positions = {}
+    for i, key in enumerate(keys):
+        positions.setdefault(key, i)
+
+    chunks = []
+    claimed = set()
+    for job in sorted(jobs.values(), key=lambda job: job["submitted"] or 0):
+        if job["status"] not in RESUMABLE_STATUSES + ["DONE"] or not job["records"]:
+            continue
+        chunk = [positions.get(key) for key in job["records"].split()]
+        if None in chunk or claimed.intersection(chunk):
+            continue
+        claimed.update(chunk)
+        chunks.append(chunk)
+
+    return chunks
+
+
+def _cache_key(query, result_format="XML"):
+    """Compute the local cache key for a search: a hash of its normalized fasta records plus the
+    search parameters. Whitespace and sequence letter case do not affect the key.
+
+    Parameters
+        query (str): one or more fasta records to search with
+        result_format (str): format the results are fetched in, one of RESULT_FORMATS
+
+    Returns
+        key (str): hex digest identifying the search
+    """
+    digest = hashlib.sha256()
+    digest.update(
+        "{}\t{}\t{}\t{}\n".format(
+            CACHE_VERSION, BLAST_PROGRAM, BLAST_DATABASE, result_format
+        ).encode()
+    )
+    for line in query.splitlines():
+        if line.startswith(">"):
+            digest.update(("\n" + " ".join(line.split()) + "\n").encode())
+        else:
+            digest.update("".join(line.split()).upper().encode())
+
+    return digest.hexdigest()
+
+
+def _sequence_length(record):
+    """Count the residues in a fasta record, or in several
+
+    Parameters
+        record (str): one or more fasta records, including their ">" header lines
+
+    Returns
+        length (int): number of residues in the records' sequences
+    """
+    return sum(
+        len("".join(line.split())) for line in record.splitlines() if not line.startswith(">")
+    )
+
+
+def _record_title(record):
+    """Read the title of a fasta record, which BLAST reports as its query definition, less any
+    trailing period
+
+    Parameters
+        record (str): a fasta record, including its ">" header line
+
+    Returns
+        title (str): the header line, without its ">" or trailing periods
+    """
+    return record.split("\n", 1)[0][1:].strip().rstrip(".")
+
+
+def _cache_rows_by_record(rows, records, keys, cache_dir):
+    """Pass the (table, row) tuples of a search through unchanged, storing each query's rows in
+    the local cache under its fasta record's key as soon as they are complete. Queries are
+    matched to records in submission order; caching stops at the first query whose length does
+    not match its record's, as the remaining results can no longer be attributed safely.
+    Results without query lengths (Tabular) also leave out queries with no hits, so their
+    queries are matched to the next record with the same title instead, and caching stops if
+    more than one remaining record has it.
+
+    Parameters
+        rows (iterable): (table, row) tuples of the search, in the order they were parsed
+        records (list): fasta records submitted in the search, in order
+        keys (list): cache key of each record, from _cache_key
+        cache_dir (str): directory holding the cache
+
+    Yields:
+        (table, row) (tuple): the rows of the search
+    """
+    pending = list(zip(records, keys))[::-1]
+    key, group = None, None
+
+    for table, row in rows:
+        if table == "queries":
+            if group is not None:
+                _write_cache(cache_dir, key, group)
+            key, group = None, None
+            if pending and row[2] is None:
+                titles = [_record_title(record) for record, _ in pending]
+                title = (row[1] or "").strip().rstrip(".")
+                if titles.count(title) == 1:
+                    index = titles.index(title)
+                    key, group = pending[index][1], []
+                    del pending[index:]
+                else:
+                    pending = []
+            elif pending:
+                record, key = pending.pop()
+                if row[2] == _sequence_length(record):
+                    group = []
+                else:
+                    pending = []
+        if group is not None:
+            group.append((table, row))
+        yield table, row
+
+    if group is not None:
+        _write_cache(cache_dir, key, group)
+
+
+def _cache_path(cache_dir, key):
+    """Locate a cache entry; entries are fanned out over subdirectories to keep them small
+
+    Parameters
+        cache_dir (str): directory holding the cache
+        key (str): cache key of the search, from _cache_key
+
+    Returns
+        path (str): path of the cache entry file
+    """
+    return os.path.join(cache_dir, key[:2], key + ".json.gz")
+
+
+def _cache_hit(cache_dir, key, ttl=None):
+    """Check whether the local cache holds a usable entry for a search, reading only the start
+    of the entry rather than all of its rows
+
+    Parameters
+        cache_dir (str): directory holding the cache
+        key (str): cache key of the search, from _cache_key
+        ttl (float): maximum age of a usable entry in seconds, or None for no limit
+
+    Returns
+        hit (bool): whether there is a usable entry, to be read with _read_cache
+    """
+    path = _cache_path(cache_dir, key)
+    try:
+        with gzip.open(path, "rt") as entry:
+            header = CACHE_HEADER.match(entry.read(64))
+    except (OSError, EOFError, ValueError):
+        return False
+
+    if header is None:
+        return False
+    if ttl is not None and time.time() - float(header[1]) > ttl:
+        # another run sharing the cache may have removed the entry already
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        return False
+
+    return True
+
+
+def _read_cache(cache_dir, key, ttl=None):
+    """Look up the result rows of an earlier, identical search in the local cache
+
+    Parameters
+        cache_dir (str): directory holding the cache
+        key (str): cache key of the search, from _cache_key
+        ttl (float): maximum age of a usable entry in seconds, or None for no limit
+
+    Returns
+        rows (list): (table, row) tuples, or None if there is no usable entry
+    """
+    path = _cache_path(cache_dir, key)
+    try:
+        with gzip.open(path, "rt") as entry:
+            cached = json.load(entry)
+    except (OSError, ValueError):
+        return None
+
+    if ttl is not None and time.time() - cached["created"] > ttl:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        return None
+
+    # refresh the entry's modification time, which _evict_cache uses as its last-used time
+    with contextlib.suppress(FileNotFoundError):
+        os.utime(path)
+    return [(table, tuple(row)) for table, row in cached["rows"]]
+
+
+def _write_cache(cache_dir, key, rows):
+    """Store the result rows of a search in the local cache; see _evict_cache for keeping it
+    within a size limit
+
+    Parameters
+        cache_dir (str): directory holding the cache
+        key (str): cache key of the search, from _cache_key
+        rows (list): (table, row) tuples to store
+
+    Returns
+        None
+    """
+    path = _cache_path(cache_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    entry = {"created": time.time(), "rows": rows}
+    _replace_file(path, lambda out: json.dump(entry, out), gzip.open)
+
+
+def _evict_cache(cache_dir, max_bytes):
+    """Delete least recently used cache entries until the cache is no larger than max_bytes.
+    Entries that another run sharing the cache removes in the meantime are skipped.
+
+    Parameters
+        cache_dir (str): directory holding the cache
+        max_bytes (int): maximum total size of the cache entries
+
+    Returns
+        None
+    """
+    entries = []
+    for dirpath, _, filenames in os.walk(cache_dir):
+        for filename in filenames:
+            if filename.endswith(".json.gz"):
+                try:
+                    stat = os.stat(os.path.join(dirpath, filename))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(dirpath, filename)))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        total -= size
+
+
+def _initialize_database(db_name, schema="text"):
+    """
+    Create a SQLite database containing queries, hits, and hsps tables
+
+    Parameters:
+        db_name (str): Name of output SQLite database
+        schema (str): layout of the tables, a key of SCHEMAS
+
+    Returns:
+        bool: True on success, or prints an error and exits the program on Exception
+    """
+    start = time.perf_counter()
+    try:
+        conn = sqlite3.connect(db_name)
+
+        for create in SCHEMAS[schema][0]:
+            conn.execute(create)
+        _check_tables(conn, db_name, schema)
+
+        conn.commit()
+        conn.close()
+
+    except Exception:
+        print("An error occurred when trying to initialize the SQLite database.")
+        sys.exit(1)
+
+    _emit_metric("initialize", time.perf_counter() - start)
+    return True
+
+
+def _check_tables(conn, db_name, schema="text"):
+    """
+    Make sure the tables of a database are laid out as the schema lays them out; those of a
+    database created by an earlier version of BLASTrunner, or with another schema, may not be
+
+    Parameters
+        conn (obj of class sqlite3.Connection): connection to the output SQLite database
+        db_name (str): Name of output SQLite database
+        schema (str): layout of the tables, a key of SCHEMAS
+
+    Returns
+        None; prints an error and exits the program if any table is laid out differently
+    """
+    expected = sqlite3.connect(":memory:")
+    for create in SCHEMAS[schema][0]:
+        expected.execute(create)
+    # SQLite's own tables, such as sqlite_sequence, are not part of the schema's layout
+    tables = [
+        row[0]
+        for row in expected.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'"
+        )
+    ]
+
+    mismatched = []
+    for table in tables:
+        layout = "PRAGMA table_info({})".format(table)
+        if conn.execute(layout).fetchall() != expected.execute(layout).fetchall():
+            mismatched.append(table)
+    expected.close()
+
+    if mismatched:
         print(
-            "Performing web BLAST blastn query against nr database with fasta file {}".format(
-                args.input_file
+            "The {} table(s) of SQLite database {} are not laid out as the {} schema expects; it "
+            "may have been created by an earlier version of BLASTrunner or with a different "
+            "--schema.".format(", ".join(mismatched), db_name, schema)
+        )
+        print("Load the results into a new database instead.")
+        sys.exit(1)
+
+
+def _bulk_load_results(db_name, rows, batch_size=BATCH_SIZE, schema="text"):
+    """
+    Create the queries, hits, and hsps tables if needed and stream result rows into all three
+    over a single connection. Rows are inserted batch_size at a time, with a commit after each
+    batch, so memory use is bounded by the batch size rather than by the size of the results.
+
+    Rows between ("begin", name) and ("end", name) markers, such as those of one ingested file,
+    are instead committed together at the end marker, or all rolled back at a
+    ("rollback", name) marker, so that a source that fails partway through leaves no trace.
+
+    Parameters
+        db_name (str): Name of output SQLite database
+        rows (iterable): (table, row) tuples, e.g. from _iterparse_xml_results, and any begin,
+            end, and rollback markers
+        batch_size (int): number of rows per batch, or None to load all rows in one transaction
+        schema (str): layout of the tables, a key of SCHEMAS
+
+    Returns
+        counts (dict): number of rows loaded into each table, or prints an error and exits the
+            program on a database error
+    """
+    creates, inserts = SCHEMAS[schema]
+    counts = {table: 0 for table in inserts}
+    batch = {table: [] for table in inserts}
+
+    # rows are usually parsed as they are loaded, so the time spent waiting on them is not
+    # counted as loading
+    start = time.perf_counter()
+    upstream = {"seconds": 0}
+    if METRIC_HOOKS:
+        rows = _metered(rows, upstream)
+
+    try:
+        conn = sqlite3.connect(db_name)
+        for pragma in LOAD_PRAGMAS:
+            conn.execute(pragma)
+
+        with conn:
+            for create in creates:
+                conn.execute(create)
+        _check_tables(conn, db_name, schema)
+
+        if schema == "integer":
+            rows = _integer_key_rows(conn, rows)
+        else:
+            rows = _text_key_rows(conn, rows)
+
+        batched = 0
+        # counts as they stood when the rows being committed together began, or None
+        begun = None
+        for table, row in rows:
+            if table is None:
+                # rows already batched are about to be replaced, so must be written out first
+                _insert_batch(conn, inserts, batch, counts, commit=begun is None)
+                batched = 0
+                continue
+            if table in ("begin", "end"):
+                _insert_batch(conn, inserts, batch, counts)
+                batched = 0
+                begun = dict(counts) if table == "begin" else None
+                continue
+            if table == "rollback":
+                for rows_batched in batch.values():
+                    rows_batched.clear()
+                batched = 0
+                conn.rollback()
+                counts.update(begun)
+                begun = None
+                continue
+            batch[table].append(row)
+            batched += 1
+            if batch_size and batched >= batch_size:
+                _insert_batch(conn, inserts, batch, counts, commit=begun is None)
+                batched = 0
+        _insert_batch(conn, inserts, batch, counts)
+
+        conn.close()
+
+    except sqlite3.Error:
+        print("An error occurred when trying to load results into the SQLite database.")
+        sys.exit(1)
+
+    _emit_metric("load", time.perf_counter() - start - upstream["seconds"], rows=dict(counts))
+    return counts
+
+
+def _insert_batch(conn, inserts, batch, counts, commit=True):
+    """
+    Insert and commit a batch of rows, emptying the batch
+
+    Parameters
+        conn (obj of class sqlite3.Connection): connection to the output SQLite database
+        inserts (dict): insert statement of each table, parents first
+        batch (dict): lists of rows to insert, keyed by table name
+        counts (dict): running number of rows loaded into each table, updated in place
+        commit (bool): commit the transaction once the batch is inserted, along with anything
+            else it holds; otherwise leave it open
+
+    Returns
+        None
+    """
+    # parents first, so rows always follow the rows they refer to
+    for table in inserts:
+        conn.executemany(inserts[table], batch[table])
+        counts[table] += len(batch[table])
+        batch[table].clear()
+    if commit:
+        conn.commit()
+
+
+def _create_indexes(db_name, schema="text", indexes="all"):
+    """
+    Build the secondary indexes of a loaded database and update the query planner's statistics
+
+    Parameters
+        db_name (str): Name of output SQLite database
+        schema (str): layout of the tables, a key of SCHEMAS
+        indexes (str): which indexes to build, one of INDEX_LEVELS
+
+    Returns
+        bool: True on success, or prints an error and exits the program on a database error
+    """
+    statements = []
+    if indexes in ("joins", "all"):
+        statements += JOIN_INDEXES[schema]
+    if indexes == "all":
+        statements += FILTER_INDEXES[schema]
+    if not statements:
+        return True
+
+    start = time.perf_counter()
+    try:
+        conn = sqlite3.connect(db_name)
+        for pragma in LOAD_PRAGMAS:
+            conn.execute(pragma)
+
+        with conn:
+            for create in statements:
+                conn.execute(create)
+        conn.execute("ANALYZE")
+
+        conn.close()
+
+    except sqlite3.Error:
+        print("An error occurred when trying to index the SQLite database.")
+        sys.exit(1)
+
+    _emit_metric("index", time.perf_counter() - start, indexes=indexes)
+    return True
+
+
+def _text_key_rows(conn, rows):
+    """
+    Prepare result rows for the "text" schema: tag each hsp with the ID of its query, so hits
+    of the same subject by different queries stay distinct, and clear out the hsps previously
+    loaded for any hit that is being loaded again. Relies on each row preceding its children,
+    as yielded by _rows_from_xml_events.
+
+    Parameters
+        conn (obj of class sqlite3.Connection): connection to the output SQLite database
+        rows (iterable): (table, row) tuples, e.g. from _iterparse_xml_results
+
+    Yields:
+        (table, row) (tuple): rows for the tables of the "text" schema, or (None, None) when the
+            rows batched so far must be inserted before loading continues; begin, end, and
+            rollback markers are passed through
+    """
+    query_id = None
+    reloaded = False
+    loaded = set()
+
+    for table, row in rows:
+        if table == "queries":
+            query_id = row[0]
+            if query_id in loaded:
+                # the query's earlier rows may not have been inserted yet
+                yield None, None
+            loaded.add(query_id)
+            reloaded = (
+                conn.execute("SELECT 1 FROM queries WHERE queryID = ?", (query_id,)).fetchone()
+                is not None
+            )
+            yield table, row
+
+        elif table == "hits":
+            if reloaded:
+                conn.execute("DELETE FROM hsps WHERE queryID = ? AND hitID = ?", (row[3], row[0]))
+            yield table, row
+
+        elif table in ("begin", "end", "rollback"):
+            yield table, row
+
+        else:
+            yield table, row + (query_id,)
+
+
+def _integer_key_rows(conn, rows):
+    """
+    Convert result rows into rows for the "integer" schema, assigning integer keys to queries,
+    hits, and subjects as they stream past. Keys are tracked in in-memory dicts, seeded from
+    the database when a subject ID is first seen, so loads into an existing database share its
+    subjects. A query or hit that is already in the database keeps its key, and is yielded
+    with it to be upserted; the hsps previously loaded for such a hit are replaced. Relies on
+    each row preceding its children, as yielded by _rows_from_xml_events.
+
+    Parameters
+        conn (obj of class sqlite3.Connection): connection to the output SQLite database
+        rows (iterable): (table, row) tuples, e.g. from _iterparse_xml_results
+
+    Yields:
+        (table, row) (tuple): rows for the tables of the "integer" schema, or (None, None) when
+            the rows batched so far must be inserted before loading continues; begin, end, and
+            rollback markers are passed through
+    """
+    next_key = _next_keys(conn)
+    query_keys = {}
+    subject_keys = {}
+    hit_key = None
+    reloaded = False
+
+    for table, row in rows:
+        if table == "queries":
+            if row[0] in query_keys:
+                # the query's earlier rows may not have been inserted yet
+                yield None, None
+            existing = conn.execute(
+                "SELECT queryKey FROM queries WHERE queryID = ?", (row[0],)
+            ).fetchone()
+            reloaded = existing is not None
+            if reloaded:
+                query_keys[row[0]] = existing[0]
+            else:
+                query_keys[row[0]] = next_key["queries"]
+                next_key["queries"] += 1
+            yield "queries", (query_keys[row[0]],) + row
+
+        elif table == "hits":
+            hit_id = row[0]
+            if hit_id not in subject_keys:
+                existing = conn.execute(
+                    "SELECT subjectKey FROM subjects WHERE hitID = ?", (hit_id,)
+                ).fetchone()
+                if existing:
+                    subject_keys[hit_id] = existing[0]
+                else:
+                    subject_keys[hit_id] = next_key["subjects"]
+                    next_key["subjects"] += 1
+                    yield "subjects", (subject_keys[hit_id],) + row[:3]
+
+            existing = (
+                reloaded
+                and conn.execute(
+                    "SELECT hitKey FROM hits WHERE queryKey = ? AND subjectKey = ?",
+                    (query_keys[row[3]], subject_keys[hit_id]),
+                ).fetchone()
             )
+            if existing:
+                hit_key = existing[0]
+                conn.execute("DELETE FROM hsps WHERE hitKey = ?", existing)
+            else:
+                hit_key = next_key["hits"]
+                next_key["hits"] += 1
+            yield "hits", (hit_key, query_keys[row[3]], subject_keys[hit_id])
+
+        elif table in ("begin", "end", "rollback"):
+            yield table, row
+            if table == "rollback":
+                # the keys handed out since the rows began were rolled back along with them
+                next_key = _next_keys(conn)
+                query_keys.clear()
+                subject_keys.clear()
+
+        else:
+            yield "hsps", row[:5] + (hit_key,)
+
+
+def _next_keys(conn):
+    """
+    Find the next free integer key of each table of the "integer" schema
+
+    Parameters
+        conn (obj of class sqlite3.Connection): connection to the output SQLite database
+
+    Returns
+        next_key (dict): the next key to assign, keyed by table name
+    """
+    next_key = {}
+    for table, key in (("queries", "queryKey"), ("subjects", "subjectKey"), ("hits", "hitKey")):
+        next_key[table] = conn.execute(
+            "SELECT COALESCE(MAX({}), 0) + 1 FROM {}".format(key, table)
+        ).fetchone()[0]
+    return next_key
+
+
+def run_blast(fasta_file, output_db_name, **options):
+    """Run BLASTrunner from synchronous code; see run_blast_async
+
+    Parameters
+        fasta_file (str): fasta file to use for querying web BLAST
+        output_db_name (str): name for local results database
+        options: keyword arguments passed on to run_blast_async
+
+    Returns
+        None
+    """
+    asyncio.run(run_blast_async(fasta_file, output_db_name, **options))
+
+
+async def run_blast_async(
+    fasta_file,
+    output_db_name,
+    chunk_size=None,
+    max_in_flight=4,
+    pool_size=POOL_SIZE,
+    cache_dir=None,
+    cache_ttl=None,
+    cache_max_bytes=None,
+    batch_size=BATCH_SIZE,
+    schema="text",
+    indexes="all",
+    xml_backend=None,
+    poll_history=None,
+    poll_rate=POLL_RATE,
+    resume=False,
+    result_format="XML",
+):
+    """Procedure for BLASTrunner
+        - splits input fasta file into its sequences
+        - reuses results of sequences found in the local cache, if one is given
+        - queries web BLAST with the rest, chunk_size sequences per search, keeping up to
+          max_in_flight searches running at once, and records each search in the database's
+          job ledger so an interrupted run can be resumed
+        - streams results when ready, in result_format, parsing them as they download
+        - initializes SQLite database and streams results (queries, hits, and hsps) into it
+          in batches of batch_size rows; with several searches, each one's results are first
+          set aside in a spool file, so searches download at once and only take turns writing
+        - builds the database's secondary indexes once all results are loaded
+
+    Parameters
+        fasta_file (str): fasta file to use for querying web BLAST
+        output_db_name (str): name for local results database
+        chunk_size (int): number of sequences per web BLAST search, or None to search all at once
+        max_in_flight (int): maximum number of web BLAST searches to run concurrently
+        pool_size (int): maximum number of connections to web BLAST to keep open
+        cache_dir (str): directory of the local result cache, or None to always query web BLAST
+        cache_ttl (float): maximum age of reusable cached results in seconds, or None for no limit
+        cache_max_bytes (int): maximum size of the local result cache, or None for no limit
+        batch_size (int): number of rows inserted per database transaction, or None for one
+        schema (str): layout of the output database tables, a key of SCHEMAS
+        indexes (str): which secondary indexes to build after loading, one of INDEX_LEVELS
+        xml_backend (str): XML parser to use, one of XML_BACKENDS, or None for XML_BACKEND
+        poll_history (str): file in which to record how long searches take, and from which to
+            schedule their status checks, or None to check them once their RTOE has elapsed
+        poll_rate (float): maximum number of status checks per second across all searches
+        resume (bool): pick up the searches of an interrupted run into the same database from
+            its job ledger, rather than submitting them again
+        result_format (str): format to fetch results in, one of RESULT_FORMATS
+
+    Returns
+        None
+    """
+    records = _read_fasta(fasta_file)
+    # an existing database that cannot take the results is reported before searching
+    _initialize_database(output_db_name, schema)
+    counts = {"queries": 0, "hits": 0, "hsps": 0}
+    load_lock = threading.Lock()
+
+    def load(rows):
+        # searches finishing at the same time take turns writing to the database, and adding up
+        # what they loaded
+        with load_lock:
+            loaded = _bulk_load_results(output_db_name, rows, batch_size, schema)
+            for table in counts:
+                counts[table] += loaded[table]
+
+    keys = [_cache_key(record, result_format) for record in records]
+    # the searches of an interrupted run are picked up with the records they were made with,
+    # rather than cut again from whichever records have been cached since
+    ledger = _ledger_path(output_db_name)
+    chunks = _ledger_chunks(_read_jobs(ledger), keys) if resume else []
+    resumed = {i for chunk in chunks for i in chunk}
+
+    # results are tracked per fasta record, so only records missing from the cache are searched;
+    # cached results are only read once they are loaded, so are never all held in memory
+    misses = [i for i in range(len(records)) if i not in resumed]
+    hits = []
+    if cache_dir:
+        misses = []
+        first_seen = {}
+        for i, key in enumerate(keys):
+            # identical records only need to be searched, and loaded, once
+            if first_seen.setdefault(key, i) != i or i in resumed:
+                continue
+            if _cache_hit(cache_dir, key, cache_ttl):
+                hits.append(key)
+            else:
+                misses.append(i)
+        print("Found {} of {} sequence(s) in local cache".format(len(hits), len(records)))
+
+    try:
+        chunks += _chunk_records(misses, chunk_size)
+        if chunks:
+
+            def load_search(index, rows):
+                if cache_dir:
+                    rows = _cache_rows_by_record(
+                        rows,
+                        [records[i] for i in chunks[index]],
+                        [keys[i] for i in chunks[index]],
+                        cache_dir,
+                    )
+                if len(chunks) == 1:
+                    load(rows)
+                    return
+
+                # results are downloaded and parsed into a spool file first, so searches that
+                # finish at the same time only take turns writing to the database, rather than
+                # downloading one after another
+                descriptor, spool_file = tempfile.mkstemp(suffix=".spool")
+                os.close(descriptor)
+                try:
+                    _spool_rows(rows, spool_file, batch_size or BATCH_SIZE)
+                    load(_read_spool(spool_file))
+                finally:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(spool_file)
+
+            print("Submitting {} web BLAST search(es)...".format(len(chunks)))
+            searches = ["".join(records[i] for i in chunk) for chunk in chunks]
+            with _create_session(pool_size) as session:
+                await _run_searches(
+                    searches,
+                    max_in_flight,
+                    session=session,
+                    consume=load_search,
+                    xml_backend=_xml_backend(xml_backend),
+                    poll_history=poll_history,
+                    poll_rate=poll_rate,
+                    ledger=ledger,
+                    resume=resume,
+                    result_format=result_format,
+                )
+
+        if hits:
+            lost = []
+
+            def read_hits():
+                for key in hits:
+                    rows = _read_cache(cache_dir, key)
+                    if rows is None:
+                        lost.append(key)
+                    else:
+                        yield from rows
+
+            load(read_hits())
+            if lost:
+                print(
+                    "Cached results for {} sequence(s) could no longer be read; run again to "
+                    "search them".format(len(lost))
+                )
+    finally:
+        # trimmed once at the end, rather than walking the whole cache after every write
+        if cache_dir and cache_max_bytes is not None:
+            _evict_cache(cache_dir, cache_max_bytes)
+    print("Loaded {queries} queries, {hits} hits, and {hsps} hsps into database".format(**counts))
+
+    if indexes != "none" and _create_indexes(output_db_name, schema, indexes):
+        print("Indexed SQLite database")
+
+    print("Successfully loaded BLAST results into SQLite database!")
+    print("See README for help with querying local results database")
+
+
+def ingest(
+    xml_files,
+    output_db_name,
+    batch_size=BATCH_SIZE,
+    schema="text",
+    indexes="all",
+    xml_backend=None,
+    scan=False,
+    workers=None,
+):
+    """Procedure for loading BLAST XML results that are already on disk, e.g. from an earlier
+    search or from standalone blastn -outfmt 5, without querying web BLAST
+        - finds the XML files to load, searching any directories or glob patterns given
+        - memory-maps each XML file and parses it incrementally, in a pool of worker
+          processes if workers is given: each file on its own worker, or, if there are fewer
+          files than workers, each file split at Iteration boundaries between all of them
+        - initializes SQLite database and streams results (queries, hits, and hsps) into it
+          in batches of batch_size rows, from a single writer
+        - builds the database's secondary indexes once all results are loaded
+
+    A file that cannot be read is reported and skipped. Each file is loaded in a transaction of
+    its own, so any rows read from it before the error are rolled back, leaving the rest of the
+    database as it was, and it can be ingested again once fixed.
+
+    Parameters
+        xml_files (list): paths, directories, or glob patterns of the BLAST XML results files
+            to load
+        output_db_name (str): name for local results database
+        batch_size (int): number of rows inserted at a time, each file's in a transaction of its
+            own, or None to insert each file's rows all at once
+        schema (str): layout of the output database tables, a key of SCHEMAS
+        indexes (str): which secondary indexes to build after loading, one of INDEX_LEVELS
+        xml_backend (str): XML parser to use, one of XML_BACKENDS, or None for XML_BACKEND
+        scan (bool): extract rows with the byte scanner rather than an XML parser; faster, but
+            does not check the files are well-formed
+        workers (int): number of worker processes parsing files, or None to parse them in
+            this process
+
+    Returns
+        None; prints an error and exits the program if any file could not be read
+    """
+    xml_files = _expand_xml_paths(xml_files)
+    if not xml_files:
+        print("No BLAST XML results files found to load.")
+        sys.exit(1)
+
+    _initialize_database(output_db_name, schema)
+    print("Loading BLAST results from {} file(s)...".format(len(xml_files)))
+    xml_backend = _xml_backend(xml_backend)
+    failed = []
+    if workers and len(xml_files) < workers:
+        # too few files to keep every worker busy, so each file is split between them instead
+        rows = _read_xml_files(xml_files, output_db_name, xml_backend, scan, failed, workers)
+    elif workers:
+        rows = _read_xml_files_parallel(
+            xml_files, output_db_name, workers, xml_backend, scan, batch_size, failed
         )
-        run_blast(args.input_file, args.output_db_name)
+    else:
+        rows = _read_xml_files(xml_files, output_db_name, xml_backend, scan, failed)
+
+    counts = _bulk_load_results(output_db_name, rows, batch_size, schema)
+    print("Loaded {queries} queries, {hits} hits, and {hsps} hsps into database".format(**counts))
+
+    if indexes != "none" and _create_indexes(output_db_name, schema, indexes):
+        print("Indexed SQLite database")
+
+    if failed:
+        print("Could not read BLAST XML results from {} file(s):".format(len(failed)))
+        for xml_file in failed:
+            print("    {}".format(xml_file))
+        sys.exit(1)
+
+    print("Successfully loaded BLAST results into SQLite database!")
+    print("See README for help with querying local results database")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "input_file", nargs="?", help="Path to the fasta file to be used to query NCBI BLAST"
+    )
+    parser.add_argument(
+        "--ingest",
+        nargs="+",
+        metavar="XML_FILE",
+        help="load existing BLAST XML results files, directories of them, or glob patterns "
+        "matching them into the database instead of querying BLAST",
+    )
+    parser.add_argument(
+        "--blast-url",
+        default=BLAST_QUERY_URL,
+        help="BLAST URL API to search with (default: NCBI web BLAST, or $BLASTRUNNER_URL)",
+    )
+    parser.add_argument(
+        "-o", "--output_db_name", default="blastresults.db", help="name for local results database"
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        help="number of sequences per web BLAST search (default: all sequences in one search)",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=4,
+        help="maximum number of web BLAST searches to run concurrently",
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=POOL_SIZE,
+        help="maximum number of connections to web BLAST to keep open",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="directory in which to cache results and reuse them for identical searches",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=None,
+        help="maximum age, in seconds, of cached results to reuse (default: no limit)",
+    )
+    parser.add_argument(
+        "--cache-max-mb",
+        type=float,
+        default=None,
+        help="maximum size of the result cache; least recently used results are evicted first",
+    )
+    parser.add_argument(
+        "--poll-history",
+        default=None,
+        help="file recording how long past searches took, used to check on new searches as "
+        "soon as they are likely to be done rather than after BLAST's estimate",
+    )
+    parser.add_argument(
+        "--poll-rate",
+        type=float,
+        default=POLL_RATE,
+        help="maximum number of status checks per second across all searches",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue an interrupted run into the same database, checking on and fetching its "
+        "outstanding searches rather than submitting them again",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=BATCH_SIZE,
+        help="number of rows inserted per database transaction (0: load in a single transaction)",
+    )
+    parser.add_argument(
+        "--schema",
+        choices=sorted(SCHEMAS),
+        default="text",
+        help="layout of the output database: TEXT keys, or compact INTEGER keys (see README)",
+    )
+    parser.add_argument(
+        "--indexes",
+        choices=INDEX_LEVELS,
+        default="all",
+        help="secondary indexes to build after loading: fewer load faster, more query faster",
+    )
+    parser.add_argument(
+        "--xml-backend",
+        choices=XML_BACKENDS,
+        default=None,
+        help="XML parser for results (default: lxml if it is installed, otherwise stdlib)",
+    )
+    parser.add_argument(
+        "--result-format",
+        choices=RESULT_FORMATS,
+        default="XML",
+        help="format to fetch web BLAST results in (default: XML; the others are only checked "
+        "against synthetic results, see README)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="with --ingest, number of processes parsing files in parallel, splitting each file "
+        "between them if there are fewer files than processes (default: parse in a single "
+        "process)",
+    )
+    parser.add_argument(
+        "--scan",
+        action="store_true",
+        help="with --ingest, extract results with a fast byte scanner instead of an XML parser",
+    )
+    parser.add_argument(
+        "--metrics",
+        default=None,
+        help="file to export timings and counts of each stage of the run to (see README)",
+    )
+    parser.add_argument(
+        "--metrics-format",
+        choices=METRIC_FORMATS,
+        default="jsonl",
+        help="format of --metrics: a JSON line per stage, appended as the run goes, or "
+        "Prometheus text totals, written when the run ends",
+    )
+
+    args = parser.parse_args()
+    if not args.input_file and not args.ingest:
+        parser.error("an input fasta file or --ingest is required")
+
+    BLAST_QUERY_URL = args.blast_url
+    metrics = contextlib.nullcontext()
+    if args.metrics:
+        metrics = _exporting_metrics(args.metrics, args.metrics_format)
+
+    with metrics:
+        if args.input_file:
+            print(
+                "Performing web BLAST blastn query against nr database with fasta file {}".format(
+                    args.input_file
+                )
+            )
+            run_blast(
+                args.input_file,
+                args.output_db_name,
+                chunk_size=args.chunk_size,
+                max_in_flight=args.max_in_flight,
+                pool_size=args.pool_size,
+                cache_dir=args.cache_dir,
+                cache_ttl=args.cache_ttl,
+                cache_max_bytes=args.cache_max_mb and int(args.cache_max_mb * 1024 * 1024),
+                batch_size=args.batch_size or None,
+                schema=args.schema,
+                indexes=args.indexes,
+                xml_backend=args.xml_backend,
+                poll_history=args.poll_history,
+                poll_rate=args.poll_rate,
+                resume=args.resume,
+                result_format=args.result_format,
+            )
+        else:
+            ingest(
+                args.ingest,
+                args.output_db_name,
+                batch_size=args.batch_size or None,
+                schema=args.schema,
+                indexes=args.indexes,
+                xml_backend=args.xml_backend,
+                scan=args.scan,
+                workers=args.workers,
+            )
@@ -0,0 +1,492 @@
+"""Benchmarks for BLASTrunner
+
+Generates BLAST XML results of a chosen shape with mock_blast_server.py and times each stage
+of getting them into a database: fetching them over HTTP, parsing them with each parser,
+initializing the database, loading the rows, and indexing. For each stage it reports the
+time taken and peak memory use, and for the stages that work through the results (fetching,
+parsing, and loading) their throughput. The report can be saved as JSON to compare releases.
+Results are only fetched as XML, BLASTrunner's default; fetching them in the other formats
+BLASTrunner can ask for (see --result-format) is not benchmarked. For example, to benchmark
+200 queries of 1000 bases with 500 hits of 2 hsps each:
+
+    python benchmarks.py --queries 200 --query-length 1000 --hits 500 --hsps 2 --json bench.json
+
+The parsing and loading stages can instead be run on a real results file scaled up by
+repeating its Iterations, skipping the fetch stage. For example, test.xml repeated 1000x:
+
+    python benchmarks.py --template test.xml --scale 1000
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree import ElementTree
+
+import BLASTrunner
+from mock_blast_server import MockBLASTServer
+
+# Stages that work through the results, so have a throughput; parse stages are named
+# "parse:<parser>"
+THROUGHPUT_STAGES = ["fetch", "parse", "load"]
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, where peak memory use is not reported
+    resource = None
+
+
+def _write_scaled_xml(template, scale, xml_file):
+    """Write a BLAST XML document containing the Iterations of template repeated scale times
+
+    Parameters
+        template (str): path to a BLAST XML results file, e.g. test.xml
+        scale (int): number of copies of template's Iterations to write
+        xml_file (str): path of the document to write
+
+    Returns
+        None
+    """
+    with open(template, "rb") as xml:
+        data = xml.read()
+    start = data.index(b"<Iteration>")
+    end = data.rindex(b"</BlastOutput_iterations>")
+
+    with open(xml_file, "wb") as out:
+        out.write(data[:start])
+        for _ in range(scale):
+            out.write(data[start:end])
+        out.write(data[end:])
+
+
+def _synthetic_fasta(queries, query_length, seed=0):
+    """Make fasta records of random DNA sequences to search with
+
+    Parameters
+        queries (int): number of records
+        query_length (int): length of each sequence
+        seed (int): seed for the random sequences
+
+    Returns
+        fasta (str): the fasta-formatted records
+    """
+    rng = random.Random(seed)
+    records = []
+    for number in range(1, queries + 1):
+        sequence = "".join(rng.choice("ACGT") for _ in range(query_length))
+        lines = [sequence[i : i + 60] for i in range(0, query_length, 60)]
+        records.append(
+            ">bench_{} synthetic benchmark query {}\n{}\n".format(number, number, "\n".join(lines))
+        )
+
+    return "".join(records)
+
+
+def _count_hsps(rows):
+    """Count the hsps among (table, row) tuples as they stream past, without keeping any rows, so
+    that a streaming parser's peak memory use is its own rather than that of the results"""
+    return sum(1 for table, _ in rows if table == "hsps")
+
+
+def _parse_dom(xml_file):
+    """Parse with the original whole-document path: build the full tree, then walk it"""
+    return len(BLASTrunner._parse_xml_results(ElementTree.parse(xml_file).getroot())[2])
+
+
+def _parse_streaming(xml_file):
+    """Parse with the incremental streaming parser, using the standard library backend"""
+    return _count_hsps(BLASTrunner._iterparse_xml_results(xml_file, "stdlib"))
+
+
+def _parse_dom_lxml(xml_file):
+    """Parse with the whole-document path, building the tree with lxml"""
+    parser = BLASTrunner.lxml_etree.XMLParser(huge_tree=True)
+    root = BLASTrunner.lxml_etree.parse(xml_file, parser).getroot()
+    return len(BLASTrunner._parse_xml_results(root)[2])
+
+
+def _parse_streaming_lxml(xml_file):
+    """Parse with the incremental streaming parser, using the tag-filtered lxml backend"""
+    return _count_hsps(BLASTrunner._iterparse_xml_results(xml_file, "lxml"))
+
+
+def _parse_scan(xml_file):
+    """Extract rows with the byte scanner, without parsing the XML"""
+    return _count_hsps(BLASTrunner._scan_xml_file(xml_file))
+
+
+def _parse_parallel(xml_file):
+    """Parse with the streaming parser split between one worker process per CPU, as ingest
+    --workers does for a single file; peak memory is that of the process gathering the rows, not
+    of its workers"""
+    return _count_hsps(BLASTrunner._parse_xml_file_parallel(xml_file, backend="stdlib"))
+
+
+# Parsers to time, each returning the number of hsps it parsed
+PARSERS = {
+    "dom": _parse_dom,
+    "streaming": _parse_streaming,
+    "scan": _parse_scan,
+    "parallel": _parse_parallel,
+}
+if BLASTrunner.lxml_etree is not None:
+    PARSERS["dom-lxml"] = _parse_dom_lxml
+    PARSERS["streaming-lxml"] = _parse_streaming_lxml
+
+
+def _peak_rss_mb():
+    """Peak resident memory of this process so far, in MB, or None where it is not available"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def _isolated(stage, *args):
+    """Run a benchmark stage in a fresh process, so that the peak memory use it reports is its
+    own rather than that of every stage run before it
+
+    Parameters
+        stage (callable): function timing the stage
+        args: arguments to stage
+
+    Returns
+        the return value of stage
+    """
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(stage, *args).result()
+
+
+def _serve_mock(options, ports):
+    """Run a mock BLAST server on a free port, reporting the port on ports"""
+    server = MockBLASTServer(("localhost", 0), rtoe=0, waiting=0, **options)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def _time_fetch(url, fasta, xml_file, repeat=3):
+    """Submit a search to the BLAST URL API at url and time downloading its XML results; the
+    other formats in BLASTrunner.RESULT_FORMATS are not timed
+
+    Parameters
+        url (str): BLAST URL API to search with
+        fasta (str): fasta records to search with
+        xml_file (str): path the results are downloaded to
+        repeat (int): number of downloads; the fastest is kept
+
+    Returns
+        result (dict): best time in seconds, bytes downloaded, and peak memory use
+    """
+    BLASTrunner.BLAST_QUERY_URL = url
+    session = BLASTrunner._create_session()
+    with contextlib.redirect_stdout(io.StringIO()):
+        RID, RTOE = BLASTrunner._parse_RID_RTOE(BLASTrunner._submit_sequences(fasta, session))
+        while BLASTrunner._check_status(RID, session) == "WAITING":
+            time.sleep(0.1)
+
+    blast_params = {"CMD": "Get", "FORMAT_OBJECT": "Alignment", "FORMAT_TYPE": "XML", "RID": RID}
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with session.post(url, params=blast_params, stream=True) as response, open(
+            xml_file, "wb"
+        ) as out:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=BLASTrunner.STREAM_CHUNK_SIZE):
+                out.write(chunk)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return {"seconds": best, "bytes": os.path.getsize(xml_file), "peak_rss_mb": _peak_rss_mb()}
+
+
+def _time_parser(name, xml_file, repeat=3):
+    """Time one of PARSERS over a BLAST XML file, keeping the best of repeat runs
+
+    Parameters
+        name (str): key of the parser in PARSERS
+        xml_file (str): path to a BLAST XML results file
+        repeat (int): number of times to run the parser
+
+    Returns
+        result (dict): best time in seconds, number of hsps parsed, and peak memory use
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        hsps = PARSERS[name](xml_file)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return {"seconds": best, "hsps": hsps, "peak_rss_mb": _peak_rss_mb()}
+
+
+def _write_rows(xml_file, rows_file):
+    """Write the rows of a BLAST XML file to a file of JSON lines, one (table, row) per line, for
+    _time_load to stream back without parsing the XML
+
+    Parameters
+        xml_file (str): path to a BLAST XML results file
+        rows_file (str): path of the file to write
+
+    Returns
+        hsps (int): number of hsps written
+    """
+    hsps = 0
+    with open(rows_file, "w") as out:
+        for table, row in BLASTrunner._scan_xml_file(xml_file):
+            out.write(json.dumps([table, row]) + "\n")
+            hsps += table == "hsps"
+
+    return hsps
+
+
+def _read_rows(rows_file):
+    """Stream the (table, row) tuples written by _write_rows"""
+    with open(rows_file) as rows:
+        for line in rows:
+            table, row = json.loads(line)
+            yield table, tuple(row)
+
+
+def _time_initialize(db_file, schema="text", repeat=3):
+    """Time initializing an empty database, keeping the best of repeat runs
+
+    Parameters
+        db_file (str): path of the database to create; it is replaced on each run
+        schema (str): layout of the tables, a key of BLASTrunner.SCHEMAS
+        repeat (int): number of runs
+
+    Returns
+        result (dict): best time in seconds, and peak memory use
+    """
+    best = None
+    for _ in range(repeat):
+        if os.path.exists(db_file):
+            os.remove(db_file)
+        start = time.perf_counter()
+        BLASTrunner._initialize_database(db_file, schema)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return {"seconds": best, "peak_rss_mb": _peak_rss_mb()}
+
+
+def _time_load(rows_file, db_file, schema="text", batch_size=BLASTrunner.BATCH_SIZE, repeat=3):
+    """Time loading rows into an initialized database, keeping the best of repeat runs. Rows are
+    streamed from rows_file, and the time spent reading them is not counted, so loading is
+    timed apart from parsing. The last run's database is left at db_file, unindexed.
+
+    Parameters
+        rows_file (str): path to a file of rows, from _write_rows
+        db_file (str): path of the database to load; it is replaced on each run
+        schema (str): layout of the tables, a key of BLASTrunner.SCHEMAS
+        batch_size (int): number of rows per transaction, or None for a single transaction
+        repeat (int): number of runs
+
+    Returns
+        result (dict): best time in seconds, number of hsps loaded, and peak memory use
+    """
+    events = []
+    BLASTrunner.METRIC_HOOKS.append(events.append)
+    best = None
+    for _ in range(repeat):
+        if os.path.exists(db_file):
+            os.remove(db_file)
+        BLASTrunner._initialize_database(db_file, schema)
+        counts = BLASTrunner._bulk_load_results(db_file, _read_rows(rows_file), batch_size, schema)
+        elapsed = [event for event in events if event["stage"] == "load"][-1]["seconds"]
+        best = elapsed if best is None else min(best, elapsed)
+
+    return {"seconds": best, "hsps": counts["hsps"], "peak_rss_mb": _peak_rss_mb()}
+
+
+def _time_index(db_file, schema="text", repeat=3):
+    """Time indexing a loaded database, keeping the best of repeat runs, each on a fresh copy
+
+    Parameters
+        db_file (str): path of a loaded, unindexed database; it is left unchanged
+        schema (str): layout of the tables, a key of BLASTrunner.SCHEMAS
+        repeat (int): number of runs
+
+    Returns
+        result (dict): best time in seconds, and peak memory use
+    """
+    work_file = db_file + ".index"
+    best = None
+    for _ in range(repeat):
+        shutil.copyfile(db_file, work_file)
+        start = time.perf_counter()
+        BLASTrunner._create_indexes(work_file, schema)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    os.remove(work_file)
+
+    return {"seconds": best, "peak_rss_mb": _peak_rss_mb()}
+
+
+def run_benchmarks(
+    xml_file,
+    parsers=PARSERS,
+    repeat=3,
+    schema="text",
+    batch_size=BLASTrunner.BATCH_SIZE,
+    fetch=None,
+):
+    """Time each stage of loading BLAST XML results into a database, each in its own process
+
+    Parameters
+        xml_file (str): path to a BLAST XML results file; with fetch, the path to download to
+        parsers (iterable): names of the PARSERS to time
+        repeat (int): number of times to run each stage; the fastest run is kept
+        schema (str): layout of the database tables, a key of BLASTrunner.SCHEMAS
+        batch_size (int): number of rows per transaction, or None for a single transaction
+        fetch (tuple): (url, fasta) to search the BLAST URL API at url with fasta and download
+            the results to xml_file first, or None to use xml_file as it is
+
+    Returns
+        stages (dict): for each stage, its best time in seconds and the peak memory use of its
+            process; and for THROUGHPUT_STAGES, the hsps they handled and their throughput in
+            hsps and MB per second
+    """
+    stages = {}
+    if fetch is not None:
+        stages["fetch"] = _isolated(_time_fetch, fetch[0], fetch[1], xml_file, repeat)
+    size = os.path.getsize(xml_file)
+
+    for name in parsers:
+        stages["parse:" + name] = _isolated(_time_parser, name, xml_file, repeat)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        rows_file = os.path.join(tmp, "rows.jsonl")
+        db_file = os.path.join(tmp, "benchmark.db")
+        _isolated(_write_rows, xml_file, rows_file)
+        stages["initialize"] = _isolated(_time_initialize, db_file, schema, repeat)
+        stages["load"] = _isolated(_time_load, rows_file, db_file, schema, batch_size, repeat)
+        stages["index"] = _isolated(_time_index, db_file, schema, repeat)
+
+    hsps = max(stage.get("hsps", 0) for stage in stages.values())
+    for name, stage in stages.items():
+        if name.split(":")[0] not in THROUGHPUT_STAGES:
+            continue
+        stage.setdefault("hsps", hsps)
+        stage["hsps_per_second"] = stage["hsps"] / stage["seconds"]
+        stage["mb_per_second"] = size / 1e6 / stage["seconds"]
+
+    return stages
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=100, help="queries in the results")
+    parser.add_argument("--query-length", type=int, default=1000, help="length of each query")
+    parser.add_argument("--hits", type=int, default=200, help="hits per query")
+    parser.add_argument("--hsps", type=int, default=2, help="hsps per hit")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the synthetic results")
+    parser.add_argument(
+        "--template",
+        default=None,
+        help="BLAST XML file to scale up instead of generating results (skips fetching)",
+    )
+    parser.add_argument("--scale", type=int, default=100, help="copies of the template to use")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage; best is kept")
+    parser.add_argument(
+        "--parsers",
+        nargs="+",
+        choices=sorted(PARSERS),
+        default=sorted(PARSERS),
+        help="parsers to time",
+    )
+    parser.add_argument(
+        "--schema", choices=sorted(BLASTrunner.SCHEMAS), default="text", help="database layout"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=BLASTrunner.BATCH_SIZE,
+        help="rows per transaction when loading (0: a single transaction)",
+    )
+    parser.add_argument("--json", default=None, help="file to write the results to as JSON")
+
+    args = parser.parse_args()
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "lxml": BLASTrunner.lxml_etree.__version__ if BLASTrunner.lxml_etree else None,
+        "schema": args.schema,
+        "batch_size": args.batch_size,
+        "repeat": args.repeat,
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        xml_file = os.path.join(tmp, "results.xml")
+        server = None
+        if args.template:
+            _write_scaled_xml(args.template, args.scale, xml_file)
+            report["results"] = {"template": args.template, "scale": args.scale}
+            fetch = None
+            print("Scaling {} up {}x".format(args.template, args.scale))
+        else:
+            report["results"] = {
+                "queries": args.queries,
+                "query_length": args.query_length,
+                "hits": args.hits,
+                "hsps": args.hsps,
+                "seed": args.seed,
+            }
+            context = multiprocessing.get_context("spawn")
+            ports = context.Queue()
+            options = {"hits": args.hits, "hsps": args.hsps, "seed": args.seed}
+            server = context.Process(target=_serve_mock, args=(options, ports), daemon=True)
+            server.start()
+            url = "http://localhost:{}/blast/Blast.cgi".format(ports.get())
+            fetch = (url, _synthetic_fasta(args.queries, args.query_length, args.seed))
+            print(
+                "Generating {queries} queries x {hits} hits x {hsps} hsps of synthetic "
+                "results".format(**report["results"])
+            )
+
+        try:
+            stages = run_benchmarks(
+                xml_file, args.parsers, args.repeat, args.schema, args.batch_size or None, fetch
+            )
+        finally:
+            if server is not None:
+                server.terminate()
+        report["results"]["bytes"] = os.path.getsize(xml_file)
+        report["stages"] = stages
+
+    print(
+        "{:.1f} MB of results, {:,} hsps".format(
+            report["results"]["bytes"] / 1e6,
+            max(stage.get("hsps", 0) for stage in stages.values()),
+        )
+    )
+    for name, stage in stages.items():
+        print(
+            "{:<20} {:8.3f} s  {:>12} hsps/s  {:>8} MB/s  {:>8} MB peak".format(
+                name,
+                stage["seconds"],
+                "{:,.0f}".format(stage["hsps_per_second"]) if "hsps_per_second" in stage else "-",
+                "{:.1f}".format(stage["mb_per_second"]) if "hsps_per_second" in stage else "-",
+                "-" if stage["peak_rss_mb"] is None else "{:.0f}".format(stage["peak_rss_mb"]),
+            )
+        )
+
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(report, out, indent=2)
+        print("Wrote results to {}".format(args.json))
@@ -0,0 +1,523 @@
+"""Local stand-in for the NCBI BLAST Common URL API, for testing BLASTrunner offline
+
+Serves CMD=Put submissions and CMD=Get status checks (FORMAT_OBJECT=SearchInfo) and result
+downloads (FORMAT_TYPE=XML, JSON2_S, or Tabular) the way web BLAST does, but answers with
+synthetic results after a configurable wait, so BLASTrunner's concurrency, polling, and loading
+can be exercised reproducibly at any scale. For example, to serve searches that take 30 seconds,
+each returning 200 hits per query:
+
+    python mock_blast_server.py --port 8000 --waiting 30 --hits 200
+
+and, in another shell, point BLASTrunner at it:
+
+    BLASTRUNNER_URL=http://localhost:8000/blast/Blast.cgi python BLASTrunner.py test.fasta
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import escape
+
+# Number of bytes of synthetic XML written to the client at a time
+WRITE_SIZE = 64 * 1024
+
+
+def _synthetic_results(queries, hits=50, hsps=2, subjects=10000, seed=0):
+    """Make up the results of a search, with a fixed number of hits per query and hsps per hit.
+    Hits are drawn from a pool of subjects shared by all queries, and hsp scores and alignments
+    are random but determined by seed.
+
+    Parameters
+        queries (list): (queryID, queryDef, sequence) tuples, one per query
+        hits (int): number of hits per query
+        hsps (int): number of hsps per hit
+        subjects (int): size of the pool of subject sequences hits are drawn from
+        seed (int): seed for the random scores and subjects
+
+    Yields
+        (queryID, queryDef, queryLength, hits) (tuple): the results of each query in turn; each
+            hit is a dict with its hsps, using the field names of BLAST's JSON output
+    """
+    rng = random.Random(seed)
+    for query_id, query_def, sequence in queries:
+        query_hits = []
+        for hit_number, subject in enumerate(rng.sample(range(subjects), min(hits, subjects)), 1):
+            hit_hsps = []
+            for hsp_number in range(1, hsps + 1):
+                align_length = rng.randint(1, max(1, len(sequence)))
+                gaps = rng.randint(0, align_length // 20)
+                bit_score = round(align_length * rng.uniform(1.2, 1.9), 3)
+                aligned = sequence[:align_length]
+                hit_hsps.append(
+                    {
+                        "num": hsp_number,
+                        "bit_score": bit_score,
+                        "score": int(bit_score * 1.1),
+                        # rounded as the XML output writes it, so every format has the same value
+                        "evalue": float("{:g}".format(10 ** -rng.uniform(5, 180))),
+                        "identity": align_length - gaps,
+                        "positive": align_length - gaps,
+                        "query_from": 1,
+                        "query_to": align_length,
+                        "hit_from": 1,
+                        "hit_to": align_length,
+                        "align_len": align_length,
+                        "gaps": gaps,
+                        "qseq": aligned,
+                        "hseq": aligned,
+                        "midline": "|" * align_length,
+                    }
+                )
+            query_hits.append(
+                {
+                    "num": hit_number,
+                    "description": [
+                        {
+                            "id": "gnl|mock|S{}".format(subject),
+                            "accession": "S{}".format(subject),
+                            "title": "Mock subject sequence {}".format(subject),
+                        }
+                    ],
+                    "len": 1000 + subject,
+                    "hsps": hit_hsps,
+                }
+            )
+        yield query_id, query_def, len(sequence), query_hits
+
+
+def synthetic_blast_xml(queries, hits=50, hsps=2, subjects=10000, seed=0):
+    """Generate a BLAST XML results document, in pieces; see _synthetic_results
+
+    Parameters
+        queries (list): (queryID, queryDef, sequence) tuples, one per query
+        hits (int): number of hits per query
+        hsps (int): number of hsps per hit
+        subjects (int): size of the pool of subject sequences hits are drawn from
+        seed (int): seed for the random scores and subjects
+
+    Yields
+        xml (bytes): successive pieces of the document
+    """
+    yield (
+        b'<?xml version="1.0"?>\n'
+        b"<BlastOutput>\n"
+        b"  <BlastOutput_program>blastn</BlastOutput_program>\n"
+        b"  <BlastOutput_version>BLASTN 2.10.0+ (mock)</BlastOutput_version>\n"
+        b"  <BlastOutput_db>nr</BlastOutput_db>\n"
+        b"  <BlastOutput_iterations>\n"
+    )
+
+    results = _synthetic_results(queries, hits, hsps, subjects, seed)
+    for number, (query_id, query_def, query_length, query_hits) in enumerate(results, 1):
+        pieces = [
+            "    <Iteration>\n"
+            "      <Iteration_iter-num>{}</Iteration_iter-num>\n"
+            "      <Iteration_query-ID>{}</Iteration_query-ID>\n"
+            "      <Iteration_query-def>{}</Iteration_query-def>\n"
+            "      <Iteration_query-len>{}</Iteration_query-len>\n"
+            "      <Iteration_hits>\n".format(
+                number, escape(query_id), escape(query_def), query_length
+            )
+        ]
+        for hit in query_hits:
+            description = hit["description"][0]
+            pieces.append(
+                "        <Hit>\n"
+                "          <Hit_num>{}</Hit_num>\n"
+                "          <Hit_id>{}</Hit_id>\n"
+                "          <Hit_def>{}</Hit_def>\n"
+                "          <Hit_accession>{}</Hit_accession>\n"
+                "          <Hit_len>{}</Hit_len>\n"
+                "          <Hit_hsps>\n".format(
+                    hit["num"],
+                    description["id"],
+                    description["title"],
+                    description["accession"],
+                    hit["len"],
+                )
+            )
+            for hsp in hit["hsps"]:
+                pieces.append(
+                    "            <Hsp>\n"
+                    "              <Hsp_num>{num}</Hsp_num>\n"
+                    "              <Hsp_bit-score>{bit_score}</Hsp_bit-score>\n"
+                    "              <Hsp_score>{score}</Hsp_score>\n"
+                    "              <Hsp_evalue>{evalue:g}</Hsp_evalue>\n"
+                    "              <Hsp_query-from>{query_from}</Hsp_query-from>\n"
+                    "              <Hsp_query-to>{query_to}</Hsp_query-to>\n"
+                    "              <Hsp_hit-from>{hit_from}</Hsp_hit-from>\n"
+                    "              <Hsp_hit-to>{hit_to}</Hsp_hit-to>\n"
+                    "              <Hsp_query-frame>1</Hsp_query-frame>\n"
+                    "              <Hsp_hit-frame>1</Hsp_hit-frame>\n"
+                    "              <Hsp_identity>{identity}</Hsp_identity>\n"
+                    "              <Hsp_positive>{positive}</Hsp_positive>\n"
+                    "              <Hsp_gaps>{gaps}</Hsp_gaps>\n"
+                    "              <Hsp_align-len>{align_len}</Hsp_align-len>\n"
+                    "              <Hsp_qseq>{qseq}</Hsp_qseq>\n"
+                    "              <Hsp_hseq>{hseq}</Hsp_hseq>\n"
+                    "              <Hsp_midline>{midline}</Hsp_midline>\n"
+                    "            </Hsp>\n".format(**hsp)
+                )
+            pieces.append("          </Hit_hsps>\n        </Hit>\n")
+        pieces.append("      </Iteration_hits>\n    </Iteration>\n")
+        yield "".join(pieces).encode()
+
+    yield b"  </BlastOutput_iterations>\n</BlastOutput>\n"
+
+
+def synthetic_blast_json(queries, hits=50, hsps=2, subjects=10000, seed=0):
+    """Generate a single-file BLAST JSON (JSON2_S) results document, in pieces, holding one
+    report per query; see _synthetic_results
+
+    Parameters
+        queries (list): (queryID, queryDef, sequence) tuples, one per query
+        hits (int): number of hits per query
+        hsps (int): number of hsps per hit
+        subjects (int): size of the pool of subject sequences hits are drawn from
+        seed (int): seed for the random scores and subjects
+
+    Yields
+        json (bytes): successive pieces of the document
+    """
+    yield b'{\n  "BlastOutput2": [\n'
+    results = _synthetic_results(queries, hits, hsps, subjects, seed)
+    for number, (query_id, query_def, query_length, query_hits) in enumerate(results):
+        report = {
+            "report": {
+                "program": "blastn",
+                "version": "BLASTN 2.10.0+ (mock)",
+                "search_target": {"db": "nr"},
+                "results": {
+                    "search": {
+                        "query_id": query_id,
+                        "query_title": query_def,
+                        "query_len": query_length,
+                        "hits": query_hits,
+                    }
+                },
+            }
+        }
+        separator = b"    ,\n" if number else b""
+        yield separator + json.dumps(report).encode() + b"\n"
+    yield b"  ]\n}\n"
+
+
+# Columns of the mock's Tabular reports, as web BLAST lists them
+TABULAR_FIELDS = (
+    "query acc.ver, subject acc.ver, % identity, alignment length, mismatches, gap opens, "
+    "q. start, q. end, s. start, s. end, evalue, bit score"
+)
+
+
+def synthetic_blast_tabular(queries, hits=50, hsps=2, subjects=10000, seed=0):
+    """Generate a Tabular results report, in pieces, with a commented header per query and a
+    tab-separated line per hsp; see _synthetic_results
+
+    Parameters
+        queries (list): (queryID, queryDef, sequence) tuples, one per query
+        hits (int): number of hits per query
+        hsps (int): number of hsps per hit
+        subjects (int): size of the pool of subject sequences hits are drawn from
+        seed (int): seed for the random scores and subjects
+
+    Yields
+        tabular (bytes): successive pieces of the report
+    """
+    yield b"<PRE>\n"
+    results = _synthetic_results(queries, hits, hsps, subjects, seed)
+    for _, query_def, query_length, query_hits in results:
+        # web BLAST's Tabular reports identify queries by their fasta ID, not their Query_ ID
+        query_id = query_def.split()[0] if query_def.strip() else "Query"
+        pieces = [
+            "# blastn\n# Query: {}\n# Database: nr\n# Fields: {}\n# {} hits found\n".format(
+                query_def, TABULAR_FIELDS, sum(len(hit["hsps"]) for hit in query_hits)
+            )
+        ]
+        for hit in query_hits:
+            subject = hit["description"][0]["accession"] + ".1"
+            for hsp in hit["hsps"]:
+                pieces.append(
+                    "{}\t{}\t{:.3f}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{:g}\t{}\n".format(
+                        query_id,
+                        subject,
+                        100 * hsp["identity"] / hsp["align_len"],
+                        hsp["align_len"],
+                        0,
+                        min(hsp["gaps"], 1),
+                        hsp["query_from"],
+                        hsp["query_to"],
+                        hsp["hit_from"],
+                        hsp["hit_to"],
+                        hsp["evalue"],
+                        hsp["bit_score"],
+                    )
+                )
+        yield "".join(pieces).encode()
+    yield b"</PRE>\n"
+
+
+# Generator of the results document in each format the mock serves, by FORMAT_TYPE
+RESULT_FORMATS = {
+    "XML": (synthetic_blast_xml, "text/xml"),
+    "JSON2_S": (synthetic_blast_json, "application/json"),
+    "Tabular": (synthetic_blast_tabular, "text/plain"),
+}
+
+
+class MockBLASTServer(ThreadingHTTPServer):
+    """HTTP server holding the searches submitted to the mock BLAST URL API
+
+    Parameters
+        address (tuple): (host, port) to listen on; port 0 picks a free port
+        rtoe (int): RTOE reported for each search, in seconds
+        waiting (float): number of seconds each search reports WAITING before finishing
+        latency (float): number of seconds added to every response
+        failure_rate (float): fraction of searches that finish FAILED rather than READY
+        dropped_checks (int): number of status checks, the first ones made, that are dropped
+            without an answer, as by a flaky network
+        hits (int): number of hits per query in the results
+        hsps (int): number of hsps per hit in the results
+        seed (int): seed making which searches fail, and their results, reproducible
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        rtoe=10,
+        waiting=5,
+        latency=0,
+        failure_rate=0,
+        dropped_checks=0,
+        hits=50,
+        hsps=2,
+        seed=0,
+    ):
+        super().__init__(address, MockBLASTHandler)
+        self.rtoe = rtoe
+        self.waiting = waiting
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.dropped_checks = dropped_checks
+        self.hits = hits
+        self.hsps = hsps
+        self.rng = random.Random(seed)
+        self.searches = {}
+        self.requests = {"Put": 0, "SearchInfo": 0, "Alignment": 0}
+        self.lock = threading.Lock()
+
+    def count(self, request):
+        """Count a request served, safely across handler threads
+
+        Parameters
+            request (str): kind of request, a key of requests
+
+        Returns
+            None
+        """
+        with self.lock:
+            self.requests[request] += 1
+
+    def drop_check(self):
+        """Decide whether to drop a status check, safely across handler threads
+
+        Returns
+            drop (bool): whether the check should go unanswered
+        """
+        with self.lock:
+            if self.dropped_checks <= 0:
+                return False
+            self.dropped_checks -= 1
+            return True
+
+    def submit(self, query):
+        """Record a new search of the fasta records in query
+
+        Parameters
+            query (str): one or more fasta records
+
+        Returns
+            RID (str): RID of the new search
+        """
+        queries = []
+        for record in re.split("^(?=>)", query, flags=re.MULTILINE):
+            lines = record.strip().splitlines()
+            if lines and lines[0].startswith(">"):
+                queries.append((lines[0][1:].strip(), "".join("".join(lines[1:]).split())))
+
+        with self.lock:
+            number = len(self.searches) + 1
+            self.searches["MOCK{:08d}".format(number)] = {
+                "submitted": time.monotonic(),
+                "failed": self.rng.random() < self.failure_rate,
+                "seed": self.rng.randrange(2**32),
+                # query IDs are unique across searches, as web BLAST's are
+                "queries": [
+                    ("Query_{}_{}".format(number, i), query_def, sequence)
+                    for i, (query_def, sequence) in enumerate(queries, 1)
+                ],
+            }
+        return "MOCK{:08d}".format(number)
+
+    def status(self, RID):
+        """Report the status of a search: WAITING, READY, FAILED, or UNKNOWN
+
+        Parameters
+            RID (str): RID of the search
+
+        Returns
+            status (str): the search's current status
+        """
+        search = self.searches.get(RID)
+        if search is None:
+            return "UNKNOWN"
+        if time.monotonic() - search["submitted"] < self.waiting:
+            return "WAITING"
+        return "FAILED" if search["failed"] else "READY"
+
+
+class MockBLASTHandler(BaseHTTPRequestHandler):
+    """Request handler implementing the parts of the BLAST URL API that BLASTrunner uses"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.handle_blast_request()
+
+    def do_POST(self):
+        self.handle_blast_request()
+
+    def handle_blast_request(self):
+        params = parse_qs(urlsplit(self.path).query)
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            params.update(parse_qs(self.rfile.read(length).decode()))
+        params = {name: values[-1] for name, values in params.items()}
+
+        server = self.server
+        time.sleep(server.latency)
+        command = params.get("CMD")
+
+        if command == "Put":
+            server.count("Put")
+            RID = server.submit(params.get("QUERY", ""))
+            self.send_text(
+                "<!--QBlastInfoBegin\n    RID = {}\n    RTOE = {}\nQBlastInfoEnd\n-->\n".format(
+                    RID, server.rtoe
+                )
+            )
+        elif command == "Get" and params.get("FORMAT_OBJECT") == "SearchInfo":
+            server.count("SearchInfo")
+            if server.drop_check():
+                self.close_connection = True
+                return
+            status = server.status(params.get("RID"))
+            self.send_text("<!--QBlastInfoBegin\n\tStatus={}\nQBlastInfoEnd\n-->\n".format(status))
+        elif command == "Get":
+            server.count("Alignment")
+            RID = params.get("RID")
+            if server.status(RID) != "READY":
+                self.send_error(404, "No results for RID {}".format(RID))
+                return
+            result_format = params.get("FORMAT_TYPE", "XML")
+            if result_format not in RESULT_FORMATS:
+                self.send_error(400, "Unsupported FORMAT_TYPE {}".format(result_format))
+                return
+            generate, content_type = RESULT_FORMATS[result_format]
+            search = server.searches[RID]
+            self.send_results(
+                generate(search["queries"], server.hits, server.hsps, seed=search["seed"]),
+                content_type,
+            )
+        else:
+            self.send_error(400, "Unsupported request")
+
+    def send_text(self, text):
+        body = text.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_results(self, pieces, content_type):
+        # results of unknown size are sent with chunked transfer encoding
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        buffered = []
+        size = 0
+        for piece in pieces:
+            buffered.append(piece)
+            size += len(piece)
+            if size >= WRITE_SIZE:
+                self.write_chunk(b"".join(buffered))
+                buffered, size = [], 0
+        self.write_chunk(b"".join(buffered))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, data):
+        if data:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+    def log_message(self, format, *args):
+        # thousands of status checks would drown out anything else on the terminal
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    parser.add_argument("--rtoe", type=int, default=10, help="RTOE reported for each search")
+    parser.add_argument(
+        "--waiting", type=float, default=5, help="seconds each search reports WAITING"
+    )
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to responses")
+    parser.add_argument(
+        "--failure-rate", type=float, default=0, help="fraction of searches that fail"
+    )
+    parser.add_argument(
+        "--dropped-checks",
+        type=int,
+        default=0,
+        help="number of status checks, the first ones made, to drop without an answer",
+    )
+    parser.add_argument("--hits", type=int, default=50, help="hits per query in results")
+    parser.add_argument("--hsps", type=int, default=2, help="hsps per hit in results")
+    parser.add_argument("--seed", type=int, default=0, help="seed for reproducible results")
+
+    args = parser.parse_args()
+    server = MockBLASTServer(
+        (args.host, args.port),
+        rtoe=args.rtoe,
+        waiting=args.waiting,
+        latency=args.latency,
+        failure_rate=args.failure_rate,
+        dropped_checks=args.dropped_checks,
+        hits=args.hits,
+        hsps=args.hsps,
+        seed=args.seed,
+    )
+    print(
+        "Mock BLAST URL API listening on http://{}:{}/blast/Blast.cgi".format(
+            args.host, server.server_address[1]
+        )
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(
+        "Served {Put} submissions, {SearchInfo} status checks, {Alignment} downloads".format(
+            **server.requests
+        )
+    )
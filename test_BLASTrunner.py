@@ -1,8 +1,67 @@
-from BLASTrunner import _parse_xml_results
+from BLASTrunner import (
+    _bulk_load_results,
+    _cache_hit,
+    _cache_path,
+    _cache_rows_by_record,
+    _cache_key,
+    _chunk_records,
+    _collect_results,
+    _coordinate_polls,
+    _create_indexes,
+    _evict_cache,
+    _exporting_metrics,
+    ingest,
+    _iterparse_xml_results,
+    _parse_xml_file_parallel,
+    _parse_xml_results,
+    _predict_first_poll,
+    _read_jobs,
+    _read_poll_history,
+    _record_job,
+    _LedgerFailed,
+    _ledger_path,
+    _read_cache,
+    _read_fasta,
+    _rows_from_result_chunks,
+    _rows_from_xml_chunks,
+    run_blast,
+    _run_searches,
+    _scan_xml_file,
+    _scan_xml_results,
+    _stream_results,
+    _watch_status,
+    _write_cache,
+    _xml_backend,
+    POLL_MISS_TARGET,
+    POLL_STEP,
+    RESULT_FORMATS,
+    XML_BACKENDS,
+    lxml_etree,
+)
+from mock_blast_server import (
+    MockBLASTServer,
+    synthetic_blast_json,
+    synthetic_blast_tabular,
+    synthetic_blast_xml,
+)
 
+import asyncio
+import concurrent.futures
+import contextlib
+import itertools
+import json
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 from xml.etree import ElementTree
 
+import requests
+
 expected_queries = [
     (
         "Query_45934",
@@ -2084,6 +2143,37 @@ expected_hsps = [
 ]
 
 
+@contextlib.contextmanager
+def serving_mock_blast(hits=3, hsps=2, dropped_checks=0):
+    """Run a MockBLASTServer in the background, with BLASTrunner's requests sent to it; its
+    searches are READY as soon as they are submitted
+
+    Parameters
+        hits (int): number of hits per query in the results it serves
+        hsps (int): number of hsps per hit in the results it serves
+        dropped_checks (int): number of status checks it drops, the first ones made
+
+    Returns
+        context manager yielding the running server, which is shut down when the block exits
+    """
+    server = MockBLASTServer(
+        ("localhost", 0), rtoe=0, waiting=0, dropped_checks=dropped_checks, hits=hits, hsps=hsps
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://localhost:{}/blast/Blast.cgi".format(server.server_address[1])
+    try:
+        with mock.patch("BLASTrunner.BLAST_QUERY_URL", url):
+            yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _exit_worker(*args):
+    """Stand in for the work of an ingest worker process, dying instead as if it had been killed"""
+    os._exit(1)
+
+
 class TestBLASTrunner(unittest.TestCase):
     def test_parse_xml_results(self):
         root = ElementTree.parse("test.xml").getroot()
@@ -2091,6 +2181,1000 @@ class TestBLASTrunner(unittest.TestCase):
         actual = _parse_xml_results(root)
         self.assertEqual(actual, expected)
 
+    def test_iterparse_xml_results(self):
+        expected = expected_queries, expected_hits, expected_hsps
+        actual = _collect_results(_iterparse_xml_results("test.xml"))
+        self.assertEqual(actual, expected)
+
+    def test_rows_from_xml_chunks(self):
+        with open("test.xml", "rb") as xml:
+            chunks = iter(lambda: xml.read(1000), b"")
+            actual = _collect_results(_rows_from_xml_chunks(chunks))
+        expected = expected_queries, expected_hits, expected_hsps
+        self.assertEqual(actual, expected)
+
+    def test_rows_from_result_chunks(self):
+        queries = [("Query_1", "first query", "ACGTTGCA" * 10), ("Query_2", "second", "GATC" * 9)]
+
+        def rows(generate, result_format):
+            # re-split the document into small chunks so values straddle chunk boundaries
+            data = b"".join(generate(queries, hits=4, hsps=3, subjects=6))
+            chunks = (data[i : i + 7] for i in range(0, len(data), 7))
+            return _collect_results(_rows_from_result_chunks(chunks, result_format))
+
+        xml_rows = rows(synthetic_blast_xml, "XML")
+        self.assertEqual(len(xml_rows[2]), 2 * 4 * 3)
+        self.assertEqual(rows(synthetic_blast_json, "JSON2_S"), xml_rows)
+
+        # Tabular reports lack descriptions, lengths, and gaps, name hits by accession, and
+        # name queries by their fasta ID
+        xml_queries, xml_hits, xml_hsps = xml_rows
+        queries, hits, hsps = rows(synthetic_blast_tabular, "Tabular")
+        self.assertEqual([query[0] for query in queries], ["first", "second"])
+        self.assertEqual([query[2] for query in queries], [None, None])
+        self.assertEqual([hit[2] for hit in hits], [hit[2] for hit in xml_hits])
+        self.assertEqual({hit[3] for hit in hits}, {"first", "second"})
+        self.assertEqual([hit[1] for hit in hits], [None] * len(xml_hits))
+        self.assertEqual([hsp[:3] for hsp in hsps], [hsp[:3] for hsp in xml_hsps])
+        self.assertEqual({hsp[3:5] for hsp in hsps}, {(None, None)})
+
+    def test_result_format_cache_keys(self):
+        # results fetched in each format are cached separately
+        keys = {_cache_key(">seq\nACGT\n", result_format) for result_format in RESULT_FORMATS}
+        self.assertEqual(len(keys), len(RESULT_FORMATS))
+        self.assertEqual(_cache_key(">seq\nACGT\n", "XML"), _cache_key(">seq\nACGT\n"))
+
+    def test_parse_xml_file_parallel(self):
+        expected = expected_queries, expected_hits, expected_hsps
+        actual = _collect_results(_parse_xml_file_parallel("test.xml", workers=2))
+        self.assertEqual(actual, expected)
+        actual = _collect_results(_parse_xml_file_parallel("test.xml", workers=2, scan=True))
+        self.assertEqual(actual, expected)
+
+        with open("test.xml", "rb") as xml:
+            data = xml.read()
+        with tempfile.TemporaryDirectory() as tmp:
+            # errors within Iterations are found by the workers
+            broken_hit = os.path.join(tmp, "broken_hit.xml")
+            with open(broken_hit, "wb") as xml:
+                xml.write(data.replace(b"</Hit_def>", b"", 1))
+            with self.assertRaises(ValueError):
+                list(_parse_xml_file_parallel(broken_hit, workers=2))
+
+            # and the rest of the document, or one without any Iterations, is checked up front
+            broken_files = {
+                "truncated.xml": data[: len(data) * 3 // 4],
+                "broken_header.xml": data.replace(b"</BlastOutput_db>", b"", 1),
+                "error_page.xml": b"Error 502 <b>Bad gateway",
+            }
+            for name, content in broken_files.items():
+                xml_file = os.path.join(tmp, name)
+                with open(xml_file, "wb") as xml:
+                    xml.write(content)
+                with self.subTest(xml_file=name), self.assertRaises(SyntaxError):
+                    list(_parse_xml_file_parallel(xml_file, workers=2))
+
+    def test_xml_backends(self):
+        expected = expected_queries, expected_hits, expected_hsps
+        for backend in XML_BACKENDS:
+            if backend == "lxml" and lxml_etree is None:
+                continue
+            with self.subTest(backend=backend):
+                self.assertEqual(
+                    _collect_results(_iterparse_xml_results("test.xml", backend)), expected
+                )
+                with open("test.xml", "rb") as xml:
+                    chunks = iter(lambda: xml.read(1000), b"")
+                    actual = _collect_results(_rows_from_xml_chunks(chunks, backend))
+                self.assertEqual(actual, expected)
+
+        if lxml_etree is not None:
+            self.assertEqual(_parse_xml_results(lxml_etree.parse("test.xml").getroot()), expected)
+        with mock.patch("BLASTrunner.lxml_etree", None):
+            self.assertEqual(_xml_backend("lxml"), "stdlib")
+
+    def test_scan_xml_results(self):
+        expected = expected_queries, expected_hits, expected_hsps
+        self.assertEqual(_collect_results(_scan_xml_file("test.xml")), expected)
+
+        # escaped and empty text must come out as an XML parser reports it
+        with open("test.xml", "rb") as xml:
+            data = xml.read()
+        data = data.replace(
+            b"<Hit_def>Acinetobacter baumannii strain AbCAN2",
+            b"<Hit_def>Acinetobacter &amp; &#x3C;strain&#62; AbCAN2",
+        ).replace(
+            b"<Hit_def>Acinetobacter baumannii strain XL380 chromosome, complete genome</Hit_def>",
+            b"<Hit_def/>",
+        )
+        with tempfile.TemporaryFile() as xml:
+            xml.write(data)
+            xml.seek(0)
+            expected = _collect_results(_iterparse_xml_results(xml, "stdlib"))
+        self.assertEqual(expected[1][0][1][:30], "Acinetobacter & <strain> AbCAN")
+        self.assertEqual(expected[1][1][1], "")
+        self.assertEqual(_collect_results(_scan_xml_results(data)), expected)
+
+    def test_chunk_records(self):
+        records = _read_fasta("test.fasta")
+        self.assertEqual(len(records), 2)
+        self.assertTrue(records[1].startswith(">NC_003909_BCE_5738"))
+        self.assertEqual(_chunk_records(records), [records])
+        self.assertEqual(_chunk_records(records, 1), [[record] for record in records])
+
+    def test_run_searches(self):
+        records = _read_fasta("test.fasta")
+        rids = iter(["RID1", "RID2"])
+        statuses = {"RID1": iter(["WAITING", "READY"]), "RID2": iter(["READY"])}
+
+        with mock.patch(
+            "BLASTrunner._submit_sequences",
+            side_effect=lambda query, session: "RID = {}\nRTOE = 0\n".format(next(rids)),
+        ), mock.patch(
+            "BLASTrunner._check_status", side_effect=lambda RID, session: next(statuses[RID])
+        ), mock.patch(
+            "BLASTrunner._stream_results",
+            side_effect=lambda RID, session, backend, result_format: iter([("queries", RID)]),
+        ):
+            with tempfile.TemporaryDirectory() as tmp:
+                poll_history = os.path.join(tmp, "history.json")
+                results = asyncio.run(
+                    _run_searches(
+                        records,
+                        2,
+                        submit_interval=0,
+                        poll_interval=0,
+                        poll_history=poll_history,
+                        poll_rate=None,
+                    )
+                )
+                history = _read_poll_history(poll_history)
+
+        self.assertEqual(results, [[("queries", "RID1")], [("queries", "RID2")]])
+        self.assertEqual(len(history), 2)
+        self.assertEqual(sorted(entry["waiting"] is None for entry in history), [False, True])
+        self.assertEqual(sorted(entry["length"] for entry in history), [305, 319])
+
+    def test_run_searches_poll_while_fetching(self):
+        records = _read_fasta("test.fasta")
+        rids = iter(["RID1", "RID2"])
+        checked = threading.Event()
+
+        def check_status(RID, session):
+            if RID == "RID2":
+                checked.set()
+            return "READY"
+
+        def consume(index, rows):
+            # the first search's fetch only finishes once the second search has been checked
+            return index == 1 or checked.wait(5)
+
+        async def run():
+            # a default executor of one thread, which the first fetch would hold if it ran there
+            asyncio.get_running_loop().set_default_executor(
+                concurrent.futures.ThreadPoolExecutor(1)
+            )
+            return await _run_searches(
+                records, 2, submit_interval=0, poll_rate=None, consume=consume
+            )
+
+        with mock.patch(
+            "BLASTrunner._submit_sequences",
+            side_effect=lambda query, session: "RID = {}\nRTOE = 0\n".format(next(rids)),
+        ), mock.patch("BLASTrunner._check_status", side_effect=check_status), mock.patch(
+            "BLASTrunner._stream_results", return_value=iter([])
+        ):
+            self.assertEqual(asyncio.run(run()), [True, True])
+
+    def test_run_searches_failed(self):
+        records = _read_fasta("test.fasta")
+
+        async def run():
+            with self.assertRaises(SystemExit):
+                await _run_searches(records, submit_interval=0, poll_interval=0, poll_rate=None)
+            return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+        # the second search fails, or is never accepted by web BLAST
+        for responses in (["RID1", "RID2"], ["RID1", None]):
+            rids = iter(responses)
+            statuses = {"RID1": itertools.repeat("WAITING"), "RID2": iter(["FAILED"])}
+
+            def submit(query, session):
+                RID = next(rids)
+                return "RID = {}\nRTOE = 0\n".format(RID) if RID else "Error\n"
+
+            with self.subTest(responses=responses), mock.patch(
+                "BLASTrunner._submit_sequences", side_effect=submit
+            ), mock.patch(
+                "BLASTrunner._check_status", side_effect=lambda RID, session: next(statuses[RID])
+            ), mock.patch(
+                "builtins.print"
+            ):
+                pending = asyncio.run(run())
+
+            # the search still WAITING is stopped rather than left running
+            self.assertTrue(all(task.done() or task.cancelling() for task in pending))
+
+    def test_run_searches_ledger_failed(self):
+        records = _read_fasta("test.fasta")
+        rids = iter(["RID1", "RID2"])
+
+        def record_job(db_name, key, **fields):
+            # recording the second search fails
+            if fields.get("RID") == "RID2":
+                raise _LedgerFailed(db_name)
+
+        async def run():
+            with self.assertRaises(SystemExit):
+                await _run_searches(
+                    records, submit_interval=0, poll_interval=0, poll_rate=None, ledger="jobs"
+                )
+            return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+        with mock.patch(
+            "BLASTrunner._submit_sequences",
+            side_effect=lambda query, session: "RID = {}\nRTOE = 0\n".format(next(rids)),
+        ), mock.patch("BLASTrunner._record_job", side_effect=record_job), mock.patch(
+            "BLASTrunner._check_status", return_value="WAITING"
+        ), mock.patch(
+            "builtins.print"
+        ) as printed:
+            pending = asyncio.run(run())
+
+        # the search still WAITING is stopped, and the failure reported, rather than a traceback
+        self.assertTrue(all(task.done() or task.cancelling() for task in pending))
+        self.assertIn("job ledger", printed.call_args[0][0])
+
+    def test_resume_searches(self):
+        records = _read_fasta("test.fasta")
+        submitted = []
+
+        def submit(query, session):
+            submitted.append(query)
+            return "RID = RID{}\nRTOE = 0\n".format(len(submitted))
+
+        with tempfile.TemporaryDirectory() as tmp, mock.patch(
+            "BLASTrunner._submit_sequences", side_effect=submit
+        ), mock.patch("BLASTrunner._check_status", return_value="READY"), mock.patch(
+            "BLASTrunner._stream_results",
+            side_effect=lambda RID, session, backend, result_format: iter([("queries", RID)]),
+        ):
+            ledger = os.path.join(tmp, "results.db")
+
+            def run(resume):
+                return asyncio.run(
+                    _run_searches(
+                        records,
+                        submit_interval=0,
+                        poll_rate=None,
+                        ledger=ledger,
+                        resume=resume,
+                    )
+                )
+
+            self.assertEqual(run(False), [[("queries", "RID1")], [("queries", "RID2")]])
+            jobs = _read_jobs(ledger)
+            self.assertEqual(sorted(job["status"] for job in jobs.values()), ["DONE", "DONE"])
+
+            # a run interrupted while the second search was running picks it back up by RID
+            key = _cache_key(records[1])
+            _record_job(ledger, key, RID="RID9", submitted=0, RTOE=30, status="WAITING")
+            self.assertEqual(run(True), [None, [("queries", "RID9")]])
+            self.assertEqual(len(submitted), 2)
+            self.assertEqual(_read_jobs(ledger)[key]["status"], "DONE")
+
+            # without resume, every search is submitted again
+            run(False)
+            self.assertEqual(len(submitted), 4)
+
+    def test_resume_expired_search(self):
+        with serving_mock_blast() as server, tempfile.TemporaryDirectory() as tmp, mock.patch(
+            "builtins.print"
+        ):
+            db_name = os.path.join(tmp, "results.db")
+            run_blast("test.fasta", db_name, poll_rate=None)
+
+            # as if interrupted while the search was running, and resumed once web BLAST had
+            # expired its results: its records are searched again, rather than the run failing
+            ((key, job),) = _read_jobs(_ledger_path(db_name)).items()
+            _record_job(_ledger_path(db_name), key, RID="MOCKEXPIRED", status="WAITING")
+            run_blast("test.fasta", db_name, poll_rate=None, resume=True)
+
+            self.assertEqual(server.requests["Put"], 2)
+            self.assertEqual(server.requests["Alignment"], 2)
+            resubmitted = _read_jobs(_ledger_path(db_name))[key]
+            self.assertEqual(resubmitted["status"], "DONE")
+            self.assertEqual(resubmitted["RID"], "MOCK00000002")
+            self.assertEqual(resubmitted["records"], job["records"])
+
+    def test_resume_searches_with_cache(self):
+        records = _read_fasta("test.fasta")
+        with serving_mock_blast() as server, tempfile.TemporaryDirectory() as tmp, mock.patch(
+            "builtins.print"
+        ):
+            db_name = os.path.join(tmp, "results.db")
+            cache_dir = os.path.join(tmp, "cache")
+            run_blast("test.fasta", db_name, poll_rate=None, cache_dir=cache_dir)
+
+            # as if interrupted once the first sequence's results were cached, but not the
+            # second's: the search is picked up by its RID with both sequences, rather than
+            # the second being submitted on its own
+            ((key, job),) = _read_jobs(_ledger_path(db_name)).items()
+            _record_job(_ledger_path(db_name), key, status="READY")
+            os.remove(_cache_path(cache_dir, _cache_key(records[1])))
+            run_blast("test.fasta", db_name, poll_rate=None, cache_dir=cache_dir, resume=True)
+
+            self.assertEqual(server.requests["Put"], 1)
+            self.assertEqual(server.requests["Alignment"], 2)
+            self.assertEqual(_read_jobs(_ledger_path(db_name))[key]["status"], "DONE")
+            self.assertTrue(_cache_hit(cache_dir, _cache_key(records[1])))
+            conn = sqlite3.connect(db_name)
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM hsps").fetchone()[0], 2 * 3 * 2)
+            conn.close()
+
+    def test_run_blast_against_mock_server(self):
+        with serving_mock_blast() as server, tempfile.TemporaryDirectory() as tmp, mock.patch(
+            "builtins.print"
+        ):
+            db_name = os.path.join(tmp, "results.db")
+            run_blast("test.fasta", db_name, poll_rate=None)
+
+            conn = sqlite3.connect(db_name)
+            lengths = conn.execute("SELECT queryLength FROM queries").fetchall()
+            hsps = conn.execute("SELECT COUNT(*) FROM hsps").fetchone()[0]
+            conn.close()
+
+        self.assertEqual(sorted(lengths), [(query[2],) for query in expected_queries])
+        self.assertEqual(hsps, 2 * 3 * 2)
+        self.assertEqual(server.requests["Put"], 1)
+        self.assertEqual(server.requests["Alignment"], 1)
+
+    def test_stream_results_http_error(self):
+        # the mock server answers an unknown RID with a 404 error page, which must not be parsed
+        with serving_mock_blast():
+            with self.assertRaises(requests.HTTPError):
+                list(_stream_results("UNKNOWN"))
+
+    def test_run_blast_downloads_searches_at_once(self):
+        # each search's download only finishes once the other's has started, so the run would
+        # time out if searches took turns downloading, rather than only loading
+        started = threading.Barrier(2, timeout=10)
+
+        def stream_results(*args, **kwargs):
+            started.wait()
+            yield from _stream_results(*args, **kwargs)
+
+        async def run_searches(*args, **kwargs):
+            return await _run_searches(*args, submit_interval=0, **kwargs)
+
+        with serving_mock_blast() as server, tempfile.TemporaryDirectory() as tmp, mock.patch(
+            "BLASTrunner._stream_results", side_effect=stream_results
+        ), mock.patch("BLASTrunner._run_searches", side_effect=run_searches), mock.patch(
+            "builtins.print"
+        ):
+            db_name = os.path.join(tmp, "results.db")
+            run_blast("test.fasta", db_name, chunk_size=1, poll_rate=None)
+
+            conn = sqlite3.connect(db_name)
+            hsps = conn.execute("SELECT COUNT(*) FROM hsps").fetchone()[0]
+            conn.close()
+
+        self.assertEqual(server.requests["Alignment"], 2)
+        self.assertEqual(hsps, 2 * 3 * 2)
+
+    def test_run_blast_retries_dropped_status_check(self):
+        with serving_mock_blast(
+            dropped_checks=1
+        ) as server, tempfile.TemporaryDirectory() as tmp, mock.patch(
+            "BLASTrunner.POLL_RETRY_DELAY", 0.01
+        ), mock.patch(
+            "builtins.print"
+        ):
+            db_name = os.path.join(tmp, "results.db")
+            run_blast("test.fasta", db_name, poll_rate=None)
+
+            conn = sqlite3.connect(db_name)
+            hsps = conn.execute("SELECT COUNT(*) FROM hsps").fetchone()[0]
+            conn.close()
+
+        # the search is checked again, rather than the run failing on the dropped check
+        self.assertEqual(server.requests["SearchInfo"], 2)
+        self.assertEqual(server.requests["Alignment"], 1)
+        self.assertEqual(hsps, 2 * 3 * 2)
+
+    def test_tabular_results_cache(self):
+        with serving_mock_blast() as server, tempfile.TemporaryDirectory() as tmp, mock.patch(
+            "BLASTrunner._evict_cache", wraps=_evict_cache
+        ) as evict, mock.patch("builtins.print"):
+            cache_dir = os.path.join(tmp, "cache")
+            hsps = []
+            for run in ("first.db", "second.db"):
+                db_name = os.path.join(tmp, run)
+                run_blast(
+                    "test.fasta",
+                    db_name,
+                    poll_rate=None,
+                    cache_dir=cache_dir,
+                    cache_max_bytes=1024 * 1024,
+                    result_format="Tabular",
+                )
+                conn = sqlite3.connect(db_name)
+                hsps.append(conn.execute("SELECT * FROM hsps ORDER BY hspID").fetchall())
+                conn.close()
+
+        # the second run is answered entirely from the cache, which is trimmed once per run
+        self.assertEqual(server.requests["Put"], 1)
+        self.assertEqual(evict.call_count, 2)
+        self.assertEqual(len(hsps[0]), 2 * 3 * 2)
+        self.assertEqual(hsps[1], hsps[0])
+
+    def test_metrics(self):
+        events = []
+
+        with serving_mock_blast(), tempfile.TemporaryDirectory() as tmp, mock.patch(
+            "BLASTrunner.METRIC_HOOKS", [events.append]
+        ), mock.patch("builtins.print"):
+            jsonl_file = os.path.join(tmp, "metrics.jsonl")
+            prometheus_file = os.path.join(tmp, "metrics.prom")
+            with _exporting_metrics(jsonl_file), _exporting_metrics(prometheus_file, "prometheus"):
+                run_blast("test.fasta", os.path.join(tmp, "results.db"), poll_rate=None)
+
+            with open(jsonl_file) as metrics:
+                lines = [json.loads(line) for line in metrics]
+            with open(prometheus_file) as metrics:
+                prometheus = metrics.read().splitlines()
+
+        stages = {event["stage"]: event for event in events}
+        self.assertEqual(
+            sorted(stages),
+            ["fetch", "index", "initialize", "load", "parse", "poll", "submit", "wait"],
+        )
+        self.assertEqual(stages["poll"]["status"], "READY")
+        # one load per search, and none for a cache that was not given
+        self.assertEqual([event["stage"] for event in events].count("load"), 1)
+        self.assertGreater(stages["fetch"]["bytes"], 0)
+        self.assertEqual(stages["parse"]["rows"], {"queries": 2, "hits": 6, "hsps": 12})
+        self.assertTrue(all(event["seconds"] >= 0 for event in events))
+
+        self.assertEqual([line["stage"] for line in lines], [event["stage"] for event in events])
+        self.assertEqual(len({line["run"] for line in lines}), 1)
+        self.assertIn('blastrunner_stage_rows_total{stage="parse",table="hsps"} 12', prometheus)
+        self.assertIn('blastrunner_polls_total{status="READY"} 1', prometheus)
+        self.assertIn("# TYPE blastrunner_stage_seconds_total counter", prometheus)
+
+    def test_coordinate_polls(self):
+        statuses = {"RID1": iter(["WAITING", "READY"]), "RID2": iter(["FAILED"]), "RID3": iter([])}
+        checks = []
+
+        def check_status(RID, session):
+            checks.append((RID, time.monotonic()))
+            return next(statuses[RID])
+
+        async def watch():
+            polls = []
+            wakeup = asyncio.Event()
+            coordinator = asyncio.create_task(
+                _coordinate_polls(polls, wakeup, poll_interval=0.05, rate=20)
+            )
+            # RIDs are checked in order of when they are due, not when they were added
+            futures = [
+                _watch_status(polls, wakeup, "RID1", 0.02),
+                _watch_status(polls, wakeup, "RID2", 0),
+                _watch_status(polls, wakeup, "RID3", 60),
+            ]
+            results = await asyncio.gather(*futures[:2])
+            coordinator.cancel()
+            return results
+
+        with mock.patch("BLASTrunner._check_status", side_effect=check_status):
+            results = asyncio.run(watch())
+
+        self.assertEqual(results[0][0], "READY")
+        self.assertGreaterEqual(results[0][1], 0.02)
+        self.assertEqual(results[1], ("FAILED", None))
+        self.assertEqual([RID for RID, _ in checks], ["RID2", "RID1", "RID1"])
+        # no more than 20 checks a second, across all RIDs
+        times = [checked for _, checked in checks]
+        self.assertTrue(all(b - a >= 0.045 for a, b in zip(times, times[1:])))
+
+    def test_coordinate_polls_retries(self):
+        checks = []
+
+        def check_status(RID, session):
+            checks.append(RID)
+            raise requests.ConnectionError("connection dropped")
+
+        async def watch():
+            polls = []
+            wakeup = asyncio.Event()
+            coordinator = asyncio.create_task(_coordinate_polls(polls, wakeup, rate=None))
+            try:
+                return await _watch_status(polls, wakeup, "RID1")
+            finally:
+                coordinator.cancel()
+
+        with mock.patch("BLASTrunner._check_status", side_effect=check_status), mock.patch(
+            "BLASTrunner.POLL_RETRIES", 2
+        ), mock.patch("BLASTrunner.POLL_RETRY_DELAY", 0.01), mock.patch("builtins.print"):
+            with self.assertRaises(requests.ConnectionError):
+                asyncio.run(watch())
+
+        # the first check and two retries
+        self.assertEqual(checks, ["RID1"] * 3)
+
+    def test_predict_first_poll(self):
+        def entry(length, RTOE, first, waiting):
+            return {
+                "program": "blastn",
+                "database": "nr",
+                "length": length,
+                "RTOE": RTOE,
+                "first": first,
+                "waiting": waiting,
+                "ready": first if waiting is None else waiting + 60,
+            }
+
+        # too little history to go on
+        history = [entry(300, 60, 30, None), entry(300, 60, 30, None)]
+        self.assertEqual(_predict_first_poll(history, 40, 300), 40)
+
+        # searches of similar length were READY when first checked at half their RTOE, so the
+        # next is checked a little earlier, until some are found still running
+        history.append(entry(280, 40, 20, None))
+        first_poll = _predict_first_poll(history, 40, 300)
+        self.assertAlmostEqual(first_poll, 20 * math.exp(-POLL_STEP * POLL_MISS_TARGET))
+        history.append(entry(300, 40, first_poll, first_poll))
+        self.assertGreater(_predict_first_poll(history, 40, 300), first_poll)
+
+        # too few searches of this length, so all of them are used
+        self.assertLess(_predict_first_poll(history, 40, 5000), 40)
+
+    def test_result_cache(self):
+        rows = [("queries", expected_queries[0]), ("hits", expected_hits[0])]
+        key = _cache_key(">seq1 test\nACGT\nACGT\n")
+        self.assertEqual(key, _cache_key(">seq1  test\r\nacgtACGT\n"))
+        self.assertNotEqual(key, _cache_key(">seq1 test\nACGTACGA\n"))
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.assertIsNone(_read_cache(cache_dir, key))
+            self.assertFalse(_cache_hit(cache_dir, key))
+            _write_cache(cache_dir, key, rows)
+            self.assertTrue(_cache_hit(cache_dir, key, ttl=3600))
+            self.assertEqual(_read_cache(cache_dir, key), rows)
+            self.assertEqual(_read_cache(cache_dir, key, ttl=3600), rows)
+            self.assertIsNone(_read_cache(cache_dir, key, ttl=-1))
+            _write_cache(cache_dir, key, rows)
+            self.assertFalse(_cache_hit(cache_dir, key, ttl=-1))
+            self.assertIsNone(_read_cache(cache_dir, key))
+
+            other_key = _cache_key(">seq2\nTTTT\n")
+            _write_cache(cache_dir, key, rows)
+            _write_cache(cache_dir, other_key, rows)
+            os.utime(os.path.join(cache_dir, key[:2], key + ".json.gz"), (0, 0))
+            other_path = os.path.join(cache_dir, other_key[:2], other_key + ".json.gz")
+            _evict_cache(cache_dir, os.path.getsize(other_path))
+            self.assertIsNone(_read_cache(cache_dir, key))
+            self.assertEqual(_read_cache(cache_dir, other_key), rows)
+
+            # another run sharing the cache removes each entry just before this one does
+            remove = os.remove
+
+            def remove_raced(path):
+                remove(path)
+                remove(path)
+
+            with mock.patch("os.remove", side_effect=remove_raced):
+                _write_cache(cache_dir, key, rows)
+                self.assertFalse(_cache_hit(cache_dir, key, ttl=-1))
+                _write_cache(cache_dir, key, rows)
+                self.assertIsNone(_read_cache(cache_dir, key, ttl=-1))
+                _evict_cache(cache_dir, 0)
+            self.assertIsNone(_read_cache(cache_dir, other_key))
+
+    def test_cache_rows_by_record(self):
+        records = _read_fasta("test.fasta")
+        keys = [_cache_key(record) for record in records]
+        rows = list(_iterparse_xml_results("test.xml"))
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.assertEqual(list(_cache_rows_by_record(rows, records, keys, cache_dir)), rows)
+            cached = [_read_cache(cache_dir, key) for key in keys]
+            self.assertEqual(list(itertools.chain.from_iterable(cached)), rows)
+            self.assertEqual(
+                [group[0] for group in cached], [("queries", q) for q in expected_queries]
+            )
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            # without query lengths, queries are matched by title, skipping any left out
+            second = rows.index(("queries", expected_queries[1]))
+            tabular = [("queries", expected_queries[1][:2] + (None,))] + rows[second + 1 :]
+            list(_cache_rows_by_record(tabular, records, keys, cache_dir))
+            self.assertIsNone(_read_cache(cache_dir, keys[0]))
+            self.assertEqual(_read_cache(cache_dir, keys[1]), tabular)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            # results that don't line up with the submitted records are never cached
+            list(_cache_rows_by_record(rows, records[::-1], keys[::-1], cache_dir))
+            self.assertEqual([_read_cache(cache_dir, key) for key in keys], [None, None])
+
+    def test_bulk_load_results(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_name = os.path.join(tmp, "results.db")
+            counts = _bulk_load_results(db_name, _iterparse_xml_results("test.xml"), batch_size=7)
+            self.assertEqual(
+                counts,
+                {
+                    "queries": len(expected_queries),
+                    "hits": len(expected_hits),
+                    "hsps": len(expected_hsps),
+                },
+            )
+
+            conn = sqlite3.connect(db_name)
+            self.assertEqual(conn.execute("SELECT * FROM queries").fetchall(), expected_queries)
+            self.assertEqual(conn.execute("SELECT * FROM hits").fetchall(), expected_hits)
+            self.assertEqual(
+                conn.execute(
+                    "SELECT alignLength, bitScore, eValue, gaps, percentID, hitID FROM hsps"
+                ).fetchall(),
+                expected_hsps,
+            )
+            conn.close()
+
+    def test_ingest(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # with more workers than files, each file is split between the workers
+            for scan, workers in itertools.product((False, True), (None, 4)):
+                db_name = os.path.join(tmp, "{}-{}.db".format(scan, workers))
+                with mock.patch("builtins.print"):
+                    ingest(
+                        ["test.xml", "test.xml"],
+                        db_name,
+                        indexes="none",
+                        scan=scan,
+                        workers=workers,
+                    )
+
+                # the second copy of the results merges into the first
+                conn = sqlite3.connect(db_name)
+                self.assertEqual(conn.execute("SELECT * FROM queries").fetchall(), expected_queries)
+                self.assertEqual(conn.execute("SELECT * FROM hits").fetchall(), expected_hits)
+                self.assertEqual(
+                    conn.execute("SELECT COUNT(*) FROM hsps").fetchone()[0], len(expected_hsps)
+                )
+                conn.close()
+
+            with mock.patch("builtins.print"), self.assertRaises(SystemExit):
+                ingest([os.path.join(tmp, "missing.xml")], db_name)
+
+    def test_ingest_file_missing_elements(self):
+        with open("test.xml", "rb") as xml:
+            data = xml.read()
+        start = data.index(b"<Iteration_query-len>")
+        end = data.index(b"\n", start)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            archive = os.path.join(tmp, "archive")
+            os.makedirs(archive)
+            # a well-formed file missing a field is reported and skipped like a malformed one
+            with open(os.path.join(archive, "0_missing.xml"), "wb") as xml:
+                xml.write(data[:start] + data[end:])
+            with open(os.path.join(archive, "good.xml"), "wb") as xml:
+                xml.write(data)
+
+            for scan in (False, True):
+                db_name = os.path.join(tmp, "scan.db" if scan else "parse.db")
+                with mock.patch("builtins.print") as output, self.assertRaises(SystemExit):
+                    ingest([archive], db_name, indexes="none", scan=scan)
+                self.assertIn(
+                    mock.call("    {}".format(os.path.join(archive, "0_missing.xml"))),
+                    output.call_args_list,
+                )
+
+                conn = sqlite3.connect(db_name)
+                self.assertEqual(conn.execute("SELECT * FROM queries").fetchall(), expected_queries)
+                self.assertEqual(
+                    conn.execute("SELECT COUNT(*) FROM hsps").fetchone()[0], len(expected_hsps)
+                )
+                conn.close()
+
+    def test_ingest_directory_in_parallel(self):
+        with open("test.xml", "rb") as xml:
+            data = xml.read()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            archive = os.path.join(tmp, "archive")
+            os.makedirs(os.path.join(archive, "2020"))
+            with open(os.path.join(archive, "2020", "good.xml"), "wb") as xml:
+                xml.write(data)
+            # a truncated file is reported and skipped without stopping the others, and the
+            # rows it loaded are rolled back, leaving those of the same queries loaded from
+            # other files untouched
+            with open(os.path.join(archive, "truncated.xml"), "wb") as xml:
+                xml.write(data[: len(data) * 3 // 4])
+
+            db_name = os.path.join(tmp, "results.db")
+            with mock.patch("builtins.print") as output, self.assertRaises(SystemExit):
+                ingest([archive], db_name, batch_size=50, workers=2)
+            self.assertIn(
+                mock.call("    {}".format(os.path.join(archive, "truncated.xml"))),
+                output.call_args_list,
+            )
+
+            conn = sqlite3.connect(db_name)
+            self.assertEqual(conn.execute("SELECT * FROM queries").fetchall(), expected_queries)
+            self.assertEqual(conn.execute("SELECT * FROM hits").fetchall(), expected_hits)
+            self.assertEqual(
+                conn.execute("SELECT COUNT(*) FROM hsps").fetchone()[0], len(expected_hsps)
+            )
+            conn.close()
+
+            # with more files than workers, the rows of files loaded after another are set aside
+            for copy in range(3):
+                with open(os.path.join(archive, "copy{}.xml".format(copy)), "wb") as xml:
+                    xml.write(data)
+            db_name = os.path.join(tmp, "copies.db")
+            with mock.patch("builtins.print"), self.assertRaises(SystemExit):
+                ingest([archive], db_name, batch_size=5, workers=2)
+
+            conn = sqlite3.connect(db_name)
+            self.assertEqual(conn.execute("SELECT * FROM queries").fetchall(), expected_queries)
+            self.assertEqual(
+                conn.execute("SELECT COUNT(*) FROM hsps").fetchone()[0], len(expected_hsps)
+            )
+            conn.close()
+
+            for schema in ("text", "integer"):
+                db_name = os.path.join(tmp, schema + ".db")
+                with mock.patch("builtins.print"), self.assertRaises(SystemExit):
+                    ingest([archive], db_name, batch_size=5, schema=schema)
+
+                conn = sqlite3.connect(db_name)
+                self.assertEqual(
+                    conn.execute("SELECT queryID, queryDef, queryLength FROM queries").fetchall(),
+                    expected_queries,
+                )
+                self.assertEqual(
+                    conn.execute("SELECT COUNT(*) FROM hits").fetchone()[0], len(expected_hits)
+                )
+                self.assertEqual(
+                    conn.execute("SELECT COUNT(*) FROM hsps").fetchone()[0], len(expected_hsps)
+                )
+                conn.close()
+
+    def test_ingest_worker_dies(self):
+        # a dead worker breaks its pool, failing the files it was reading like unreadable ones,
+        # whether each file is read by a worker of its own or split between them
+        with open("test.xml", "rb") as xml:
+            data = xml.read()
+
+        for target, copies in (("_queue_xml_file", 3), ("_parse_iteration_range", 1)):
+            with self.subTest(target=target), tempfile.TemporaryDirectory() as tmp:
+                xml_files = [os.path.join(tmp, "copy{}.xml".format(copy)) for copy in range(copies)]
+                for xml_file in xml_files:
+                    with open(xml_file, "wb") as xml:
+                        xml.write(data)
+
+                db_name = os.path.join(tmp, "results.db")
+                with mock.patch("BLASTrunner." + target, _exit_worker), mock.patch(
+                    "builtins.print"
+                ) as output, self.assertRaises(SystemExit):
+                    ingest(xml_files, db_name, workers=2)
+                for xml_file in xml_files:
+                    self.assertIn(mock.call("    {}".format(xml_file)), output.call_args_list)
+
+                conn = sqlite3.connect(db_name)
+                self.assertEqual(conn.execute("SELECT COUNT(*) FROM queries").fetchone()[0], 0)
+                conn.close()
+
+    def test_ingest_standalone_results(self):
+        with open("test.xml", "rb") as xml:
+            data = xml.read()
+        data = data.replace(b"Query_45934", b"Query_1").replace(b"Query_45935", b"Query_2")
+        # standalone BLAST numbers the queries of every run from Query_1
+        contents = {"run1.xml": data, "run2.xml": data.replace(b"NC_0", b"other NC_0")}
+
+        with tempfile.TemporaryDirectory() as tmp:
+            xml_files = []
+            for name, content in contents.items():
+                xml_files.append(os.path.join(tmp, name))
+                with open(xml_files[-1], "wb") as xml:
+                    xml.write(content)
+
+            for workers in (None, 2, 4):
+                db_name = os.path.join(tmp, "{}.db".format(workers))
+                with mock.patch("builtins.print") as output, self.assertRaises(SystemExit):
+                    ingest(xml_files, db_name, indexes="none", workers=workers)
+                # only one run's results are kept, whichever was loaded first with workers
+                failed = [
+                    xml_file
+                    for xml_file in xml_files
+                    if mock.call("    {}".format(xml_file)) in output.call_args_list
+                ]
+                self.assertEqual(len(failed), 1)
+                self.assertIn("already loaded with a different definition", str(output.mock_calls))
+                kept = [xml_file for xml_file in xml_files if xml_file not in failed][0]
+
+                conn = sqlite3.connect(db_name)
+                self.assertEqual(
+                    conn.execute("SELECT queryDef FROM queries").fetchall(),
+                    [
+                        (row[1],)
+                        for table, row in _iterparse_xml_results(kept)
+                        if table == "queries"
+                    ],
+                )
+                self.assertEqual(
+                    conn.execute("SELECT COUNT(*) FROM hsps").fetchone()[0], len(expected_hsps)
+                )
+                conn.close()
+
+    def test_bulk_load_results_integer_schema(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_name = os.path.join(tmp, "results.db")
+            _bulk_load_results(db_name, _iterparse_xml_results("test.xml"), schema="integer")
+
+            conn = sqlite3.connect(db_name)
+            self.assertEqual(
+                conn.execute("SELECT queryID, queryDef, queryLength FROM queries").fetchall(),
+                expected_queries,
+            )
+            self.assertEqual(
+                conn.execute(
+                    "SELECT s.hitID, s.hitDef, s.accession, q.queryID FROM hits h "
+                    "JOIN subjects s ON h.subjectKey = s.subjectKey "
+                    "JOIN queries q ON h.queryKey = q.queryKey ORDER BY h.hitKey"
+                ).fetchall(),
+                expected_hits,
+            )
+            self.assertEqual(
+                conn.execute(
+                    "SELECT p.alignLength, p.bitScore, p.eValue, p.gaps, p.percentID, s.hitID "
+                    "FROM hsps p JOIN hits h ON p.hitKey = h.hitKey "
+                    "JOIN subjects s ON h.subjectKey = s.subjectKey ORDER BY p.hspID"
+                ).fetchall(),
+                expected_hsps,
+            )
+            conn.close()
+
+    def test_load_into_database_of_other_layout(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # the layout of databases created before hits were keyed by query as well
+            old_db = os.path.join(tmp, "old.db")
+            conn = sqlite3.connect(old_db)
+            conn.execute(
+                "CREATE TABLE queries "
+                "(queryID TEXT PRIMARY KEY, queryDef TEXT, queryLength INTEGER)"
+            )
+            conn.execute(
+                "CREATE TABLE hits "
+                "(hitID TEXT PRIMARY KEY, hitDef TEXT, accession TEXT, queryID TEXT)"
+            )
+            conn.execute(
+                "CREATE TABLE hsps (hspID INTEGER PRIMARY KEY AUTOINCREMENT, alignLength INTEGER, "
+                "bitScore REAL, eValue REAL, gaps INTEGER, percentID REAL, hitID TEXT)"
+            )
+            conn.close()
+
+            integer_db = os.path.join(tmp, "integer.db")
+            _bulk_load_results(integer_db, [], schema="integer")
+
+            for db_name in (old_db, integer_db):
+                with self.subTest(db_name=db_name):
+                    with mock.patch("builtins.print") as output, self.assertRaises(SystemExit):
+                        ingest(["test.xml"], db_name)
+                    self.assertIn(
+                        "not laid out as the text schema expects", str(output.call_args_list)
+                    )
+                    self.assertNotIn("sqlite_sequence", str(output.call_args_list))
+                    with mock.patch("builtins.print"), self.assertRaises(SystemExit):
+                        _bulk_load_results(db_name, _iterparse_xml_results("test.xml"))
+
+    def test_bulk_load_results_shared_hits_and_reloads(self):
+        rows = [
+            ("queries", ("Query_1", "first query", 100)),
+            ("hits", ("gi|1|gb|A1.1|", "shared subject", "A1", "Query_1")),
+            ("hsps", (100, 180.0, 1e-50, 0, 100.0, "gi|1|gb|A1.1|")),
+            ("queries", ("Query_2", "second query", 100)),
+            ("hits", ("gi|1|gb|A1.1|", "shared subject", "A1", "Query_2")),
+            ("hsps", (90, 160.0, 1e-40, 1, 90.0, "gi|1|gb|A1.1|")),
+            ("hsps", (40, 60.0, 1e-10, 0, 40.0, "gi|1|gb|A1.1|")),
+        ]
+        for schema in ("text", "integer"):
+            with self.subTest(schema=schema), tempfile.TemporaryDirectory() as tmp:
+                db_name = os.path.join(tmp, "results.db")
+                _bulk_load_results(db_name, rows, batch_size=2, schema=schema)
+                # reloaded rows are counted, whichever the schema
+                loaded = _bulk_load_results(db_name, rows, batch_size=2, schema=schema)
+                self.assertEqual(
+                    [loaded[table] for table in ("queries", "hits", "hsps")], [2, 2, 3]
+                )
+                # a query repeated within a single load replaces its earlier rows too
+                _bulk_load_results(db_name, rows + rows, batch_size=100, schema=schema)
+
+                conn = sqlite3.connect(db_name)
+                counts = [
+                    conn.execute("SELECT COUNT(*) FROM {}".format(table)).fetchone()[0]
+                    for table in ("queries", "hits", "hsps")
+                ]
+                conn.close()
+                self.assertEqual(counts, [2, 2, 3])
+
+    def test_bulk_load_results_rollback(self):
+        loaded = [
+            ("queries", ("Query_1", "first query", 100)),
+            ("hits", ("gi|1|gb|A1.1|", "first subject", "A1", "Query_1")),
+            ("hsps", (100, 180.0, 1e-50, 0, 100.0, "gi|1|gb|A1.1|")),
+        ]
+        # a source that fails partway through reloading the query, with a new subject
+        failed = [
+            ("begin", "failed.xml"),
+            ("queries", ("Query_1", "first query", 100)),
+            ("hits", ("gi|1|gb|A1.1|", "first subject", "A1", "Query_1")),
+            ("hsps", (90, 160.0, 1e-40, 1, 90.0, "gi|1|gb|A1.1|")),
+            ("hits", ("gi|2|gb|B1.1|", "second subject", "B1", "Query_1")),
+            ("hsps", (40, 60.0, 1e-10, 0, 40.0, "gi|2|gb|B1.1|")),
+            ("rollback", "failed.xml"),
+        ]
+        # and one loaded after it, with the subject that was rolled back
+        later = [
+            ("begin", "later.xml"),
+            ("queries", ("Query_2", "second query", 100)),
+            ("hits", ("gi|2|gb|B1.1|", "second subject", "B1", "Query_2")),
+            ("hsps", (40, 60.0, 1e-10, 0, 40.0, "gi|2|gb|B1.1|")),
+            ("end", "later.xml"),
+        ]
+        hits = {
+            "text": "SELECT queryID, hitID FROM hits",
+            "integer": "SELECT q.queryID, s.hitID FROM hits h "
+            "JOIN subjects s ON h.subjectKey = s.subjectKey "
+            "JOIN queries q ON h.queryKey = q.queryKey",
+        }
+        for schema in ("text", "integer"):
+            with self.subTest(schema=schema), tempfile.TemporaryDirectory() as tmp:
+                db_name = os.path.join(tmp, "results.db")
+                _bulk_load_results(db_name, loaded, schema=schema)
+                counts = _bulk_load_results(db_name, failed + later, batch_size=2, schema=schema)
+                self.assertEqual((counts["queries"], counts["hits"], counts["hsps"]), (1, 1, 1))
+
+                conn = sqlite3.connect(db_name)
+                self.assertEqual(
+                    sorted(conn.execute(hits[schema]).fetchall()),
+                    [("Query_1", "gi|1|gb|A1.1|"), ("Query_2", "gi|2|gb|B1.1|")],
+                )
+                self.assertEqual(
+                    sorted(conn.execute("SELECT bitScore FROM hsps").fetchall()),
+                    [(60.0,), (180.0,)],
+                )
+                conn.close()
+
+    def test_create_indexes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_name = os.path.join(tmp, "results.db")
+            _bulk_load_results(db_name, _iterparse_xml_results("test.xml"))
+            _create_indexes(db_name, indexes="joins")
+
+            conn = sqlite3.connect(db_name)
+            plan = conn.execute(
+                "EXPLAIN QUERY PLAN SELECT eValue, bitScore FROM hsps WHERE hitID = ?", ("gi|1|",)
+            ).fetchall()
+            self.assertIn("COVERING INDEX hsps_hit", plan[0][3])
+            self.assertEqual(
+                conn.execute(
+                    "SELECT name FROM sqlite_master WHERE name = 'hsps_percentID'"
+                ).fetchall(),
+                [],
+            )
+            conn.close()
+
+            _create_indexes(db_name, indexes="all")
+            conn = sqlite3.connect(db_name)
+            plan = conn.execute(
+                "EXPLAIN QUERY PLAN SELECT * FROM hsps WHERE percentID = 100.0"
+            ).fetchall()
+            self.assertIn("INDEX hsps_percentID", plan[0][3])
+            conn.close()
+
 
 if __name__ == "__main__":
     unittest.main()